@@ -0,0 +1,53 @@
+#In-process cache of the Merchants / CardSchemes allowlists held in setup.db.
+#Both are kept as frozensets for hash lookups. A version counter in setup.db is bumped on every
+#change, so a cached copy is reused across requests (and jobs) until some worker edits a list.
+#The merchant matcher (matching.py) is cached along with the list it was built from.
+import threading
+from matching import MerchantMatcher, FUZZY_THRESHOLD
+
+_cache = {}
+_matchers = {}
+_lock = threading.Lock()
+
+
+def createAllowlistVersion(con):
+    con.execute('CREATE TABLE IF NOT EXISTS AllowlistVersion(version integer NOT NULL);')
+    if con.execute('SELECT count(*) FROM AllowlistVersion;').fetchone()[0] == 0:
+        con.execute('INSERT INTO AllowlistVersion (version) VALUES (0);')
+    con.commit()
+
+
+def bumpAllowlists(con):
+    #Call after any insert / delete on Merchants or CardSchemes
+    con.execute('UPDATE AllowlistVersion SET version = version + 1;')
+    con.commit()
+
+
+def getAllowlists(con, database):
+    #Returns (Merchants, CardSchemes) frozensets, reloaded only when the version moved
+    row = con.execute('SELECT version FROM AllowlistVersion;').fetchone()
+    version = row[0] if row else None
+    with _lock:
+        cached = _cache.get(database)
+        if cached is not None and version is not None and cached[0] == version:
+            return cached[1], cached[2]
+
+    Merchants = frozenset(x[0] for x in con.execute('Select name from Merchants;'))
+    CardSchemes = frozenset(x[0] for x in con.execute('Select name from CardSchemes;'))
+    with _lock:
+        _cache[database] = (version, Merchants, CardSchemes)
+    return Merchants, CardSchemes
+
+
+def getMerchantMatcher(con, database, threshold=FUZZY_THRESHOLD):
+    #MerchantMatcher over the current Merchants, rebuilt only when the allowlist was reloaded
+    Merchants, CardSchemes = getAllowlists(con, database)
+    with _lock:
+        cached = _matchers.get(database)
+        if cached is not None and cached[0] is Merchants and cached[1] == threshold:
+            return cached[2]
+
+    matcher = MerchantMatcher(Merchants, threshold)
+    with _lock:
+        _matchers[database] = (Merchants, threshold, matcher)
+    return matcher
@@ -1,14 +1,27 @@
-from flask import g, Flask, render_template, request, url_for, flash, redirect, send_from_directory, session, abort
+from flask import Flask, Blueprint, current_app, render_template, request, url_for, flash, redirect, send_from_directory, session, abort, jsonify, g
 from werkzeug.utils import secure_filename
-import sqlite3
+import db
 import os
-from zipfile import ZipFile 
-from pandas_ods_reader import read_ods
-import pandas as pd
 import datetime
 import logging
+import threading
 from functools import wraps
-import math
+import uuid
+import cProfile
+import metrics
+from summary import summaryRemove
+from schema import migrate
+from reporting import reportRows
+from exporter import runExport
+from jobs import submitJob, getJob, recentJobs
+from allowlist import createAllowlistVersion, bumpAllowlists, getAllowlists, getMerchantMatcher
+from matching import FUZZY_THRESHOLD
+from browse import transactionPage, merchantPage, PAGE_SIZE
+from reportcache import ReportCache, reportKey, dataVersion, bumpDataVersion
+from partitions import deleteRows
+from search import searchTransactions, SEARCH_LIMIT
+#pandas, pandas_ods_reader and the upload readers are imported by the views that need them,
+#so worker processes start without them
 
 #Path variable
 try:
@@ -16,22 +29,64 @@ try:
 except:
     script_path = ""
 
-#SETUP LOGGING
-logging.basicConfig(filename=script_path + 'TransactionImport.log',
-                    level=logging.INFO,
-                    format='%(asctime)s %(levelname)-8s %(message)s',
-                    datefmt='%Y-%m-%d %H:%M:%S')
-
-#Initiate app
-app = Flask(__name__)
+ALLOWED_EXTENSIONS = set(['xlsx', 'ods', 'csv'])
 
+#Defaults of create_app, any key can be overridden through its config argument
+DEFAULT_CONFIG = {
+    'SECRET_KEY': '',
+    'LOG_FILE': script_path + 'TransactionImport.log',
+    'DATABASE': script_path + 'setup.db',
+    'DATABASE_TXN': script_path + 'data.db',
+    'JOBS_DATABASE': script_path + 'jobs.db',
+    'UPLOAD_FOLDER': script_path + 'uploads',
+    'EXPORT_FOLDER': script_path + 'export/',
+    #Export zip settings, EXPORT_PROCESSES None uses every cpu, 0 writes csvs in the request process
+    'EXPORT_PROCESSES': None,
+    'EXPORT_COMPRESSION_LEVEL': 6,
+    'EXPORT_ZIP64': True,
+    #Batch uploads (several files or a zip) parse files across this many processes, None uses every cpu, 0 parses in the job
+    'UPLOAD_PROCESSES': None,
+    #Uploaded merchant names are matched to Merchants ignoring case, accents, punctuation and whitespace,
+    #then by trigram similarity down to this threshold (above 1 turns the similarity match off)
+    'MERCHANT_MATCH_THRESHOLD': FUZZY_THRESHOLD,
+    #Uploaded rows failing validation are written here as csv, one file per upload, with the reasons
+    'REJECT_FOLDER': script_path + "rejects/",
+    #Exported months are also kept as parquet here (needs pyarrow) and stay visible in the report, None turns it off
+    'ARCHIVE_FOLDER': script_path + "archive/",
+    #sqlite connection pragmas, see db.py
+    'SQLITE_PRAGMAS': {'auto_vacuum': 'INCREMENTAL', 'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'cache_size': -65536, 'mmap_size': 268435456, 'busy_timeout': 30000},
+    #Phase timings served on /metrics, off by default. Logged in users can add ?profile=1 to any request
+    #to get a cProfile dump (of the background job too for uploads / exports) in PROFILE_FOLDER
+    'METRICS': False,
+    'PROFILE_FOLDER': script_path + "profiles/",
+    #Report results are cached per data version, REPORT_CACHE_DISK also keeps them as json for other worker processes
+    'REPORT_CACHE_SIZE': 64,
+    'REPORT_CACHE_DISK': False,
+    'REPORT_CACHE_FOLDER': script_path + "export/reports/",
+}
+
+bp = Blueprint('main', __name__)
+
+
+def create_app(config=None):
+    #Application factory, safe to call in every worker of a pre-forking server: nothing touches the
+    #databases here, tables are created / migrated on the first request of each process
+    app = Flask(__name__)
+    app.config.update(DEFAULT_CONFIG)
+    app.config.update(config or {})
+
+    #SETUP LOGGING
+    logging.basicConfig(filename=app.config['LOG_FILE'],
+                        level=logging.INFO,
+                        format='%(asctime)s %(levelname)-8s %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+
+    db.configure(app.config['SQLITE_PRAGMAS'])
+    metrics.enable(app.config['METRICS'])
+    app.extensions['reportCache'] = ReportCache(app.config['REPORT_CACHE_FOLDER'], app.config['REPORT_CACHE_SIZE'], app.config['REPORT_CACHE_DISK'])
+    app.register_blueprint(bp)
+    return app
 
-DATABASE = script_path + 'setup.db'
-DATABASE_TXN = script_path + 'data.db'
-UPLOAD_FOLDER = script_path + 'uploads'
-ALLOWED_EXTENSIONS = set(['xlsx', 'ods', 'csv'])
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.secret_key = ''
 
 columns = ['MerchantName',
             'ClientName',
@@ -54,41 +109,119 @@ columns = ['MerchantName',
 
 
 
-def get_db(DATABASE = DATABASE):
-    db = getattr(g, '_setup', None)
-    if db is None:
-        db = g._database = sqlite3.connect(DATABASE)
-    return db
+def get_db(DATABASE = None):
+    #Pooled per thread and per database file, see db.py. Defaults to setup.db
+    return db.connect(DATABASE or current_app.config['DATABASE'])
 
-@app.teardown_appcontext
+@bp.teardown_app_request
 def close_connection(exception):
-    db = getattr(g, '_setup', None)
-    if db is not None:
-        db.close()
+    #Connections stay open for the next request, only unfinished transactions are rolled back
+    db.release()
 
-def query_db(query, args=(), one=False, insert=False, DATABASE = DATABASE):
+def query_db(query, args=(), one=False, insert=False, DATABASE = None):
+    #With insert=True commits and returns the number of affected rows
     con = get_db(DATABASE)
     cur = con.execute(query, args)
     if insert == True:
         con.commit()
-        rv = None
+        rv = cur.rowcount
+        cur.close()
+        return rv
     else:
         rv = cur.fetchall()
 
     cur.close()
     return (rv[0] if rv else None) if one else rv
 
+#Bound parameters per statement, below the lowest sqlite limit
+BATCH_PARAMS = 500
+
+def batches(values, size = BATCH_PARAMS):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+def where_in(column, values):
+    #(clause, args) for column IN (?, ?, ...)
+    return '{} IN ({})'.format(column, ", ".join(['?'] * len(values))), tuple(values)
+
+def query_many(query, seq, DATABASE = None, con = None):
+    #executemany in one transaction, returns the number of affected rows.
+    #Pass con to take part in a wider transaction, the caller then commits
+    own = con is None
+    con = get_db(DATABASE) if own else con
+    cur = con.executemany(query, seq)
+    rv = cur.rowcount
+    cur.close()
+    if own:
+        con.commit()
+    return rv
+
+def delete_in(table, column, values, DATABASE = None, con = None):
+    #DELETE FROM table WHERE column IN (values) in one transaction, returns the number of deleted rows
+    own = con is None
+    con = get_db(DATABASE) if own else con
+    rv = 0
+    for batch in batches(values):
+        clause, args = where_in(column, batch)
+        rv += con.execute('DELETE FROM {} WHERE {};'.format(table, clause), args).rowcount
+    if own:
+        con.commit()
+    return rv
+
+def profilePath(name):
+    #Profile dump path, None unless the current request asked for profiling
+    if 'profile' not in g:
+        return None
+    os.makedirs(current_app.config['PROFILE_FOLDER'], exist_ok=True)
+    return os.path.join(current_app.config['PROFILE_FOLDER'], '{}_{}.prof'.format(datetime.datetime.now().strftime('%Y%m%d_%H%M%S_%f'), name))
+
+@bp.before_app_request
+def startProfile():
+    if request.args.get('profile') == '1' and session.get('logged_in'):
+        g.profile = cProfile.Profile()
+        g.profile.enable()
+
+@bp.after_app_request
+def stopProfile(response):
+    if 'profile' in g:
+        g.profile.disable()
+        path = profilePath(request.endpoint or 'request')
+        g.profile.dump_stats(path)
+        g.pop('profile')
+        logging.info("Request profile written to {}".format(path))
+        response.headers['X-Profile'] = os.path.basename(path)
+    return response
+
+def wantsJson():
+    #API clients ask for json through the Accept header or ?format=json
+    return request.args.get('format') == 'json' or request.accept_mimetypes.best == 'application/json'
+
+_initialized = set()
+_initLock = threading.Lock()
+
+@bp.before_app_request
+def initDatabases():
+    #Tables are created and data.db migrated once per process (and set of database files), not on every visit of home
+    key = (os.getpid(), current_app.config['DATABASE'], current_app.config['DATABASE_TXN'])
+    if key in _initialized:
+        return
+    with _initLock:
+        if key not in _initialized:
+            createdDatabases()
+            _initialized.add(key)
+
 def createdDatabases():
     query_db('CREATE TABLE IF NOT EXISTS Merchants(name text);')
     query_db('CREATE TABLE IF NOT EXISTS CardSchemes(name text);')
-    query_db('CREATE TABLE IF NOT EXISTS UploadHistory(uploadtime timestamp, filename text, success boolean, len numeric, UploadId numeric);', DATABASE = DATABASE_TXN)
-    query_db('CREATE TABLE IF NOT EXISTS data(MerchantName text, ClientName text, TransactionDate timestamp, TransactionType text, DataEntryMethod text, CurrencyCode text, DccCurrencyCode text, SaleAmount real, DccAmount real, CardNumber text, AuthMessage text, TerminalId text, CardScheme text, TransactionMode text, ExpiryDate text, ResponseCode text, UploadTime timestamp, UploadId numeric);', DATABASE = DATABASE_TXN)
-    #query_db('DROP TABLE exportHistory;', DATABASE = DATABASE_TXN, insert=True)
-    query_db('CREATE TABLE IF NOT EXISTS exportHistory(exportDate timestamp, success boolean, len numeric, filename text, exportId numeric);', DATABASE = DATABASE_TXN)
-    
+    query_db('CREATE INDEX IF NOT EXISTS Merchants_name ON Merchants(name);')
+    createAllowlistVersion(get_db())
+    #data.db tables are versioned, see schema.py
+    migrate(get_db(DATABASE = current_app.config['DATABASE_TXN']))
+
 
 
-@app.route('/login', methods=['POST'])
+@bp.route('/login', methods=['POST'])
 def do_admin_login():
     if request.form['password'] == '' and request.form['username'] == '':
         session['logged_in'] = True
@@ -98,7 +231,7 @@ def do_admin_login():
     return home()
 
 
-@app.route('/logout', methods=['GET'])
+@bp.route('/logout', methods=['GET'])
 def do_admin_logout():
     session['logged_in'] = False
     return home()
@@ -114,67 +247,65 @@ def LoggedinDecorator(f, *args, **kvargs):
 
     return wrapper
 
-@app.route('/')
+@bp.route('/')
 @LoggedinDecorator
 def home():
-    createdDatabases()
     return render_template('base.html', name=None)
 
 
-@app.route('/report')
-@LoggedinDecorator
-def report():
-    data = [x for x in query_db('Select * from data', DATABASE = DATABASE_TXN)]
-    data = pd.DataFrame(data, columns=columns)
-    if data.shape[0] == 0:
-        return render_template('report.html', data={'No Data': [[]]}, Reportcolumns=[])
-    else:
-        try:
-            os.remove(script_path + 'export/report.csv')
-        except:
-            pass
-        #CardSchemes = [x[0] for x in query_db('Select * from CardSchemes')]
-        CardSchemes = [x for x in data['CardScheme'].unique()]
-        data['Year-Month'] = data['TransactionDate'].map(lambda x: pd.to_datetime(x).strftime("%Y-%m")) 
-        data = data.groupby(['Year-Month', 'MerchantName', 'CardScheme']).agg({'TransactionDate': 'count', 'SaleAmount': 'sum'}).reset_index()
-        years = [x for x in data['Year-Month'].unique()]
-        years.sort()
-
-        
-        #print(data.head())
-        #print(years)
-
-        for card in CardSchemes:
-            data[card] = data.apply(lambda x: x['TransactionDate'] if x['CardScheme'] == card else 0, axis=1)
+def cachedReport(filters):
+    #(version, key, headers, rows) of the report for filters, computed once per data version
+    con = get_db(DATABASE = current_app.config['DATABASE_TXN'])
+    version, key = dataVersion(con), reportKey(filters['from'], filters['to'], filters['merchant'])
+    cached = current_app.extensions['reportCache'].get(version, key)
+    if cached is None:
+        cached = reportRows(con, filters['from'], filters['to'], filters['merchant'], current_app.config['ARCHIVE_FOLDER'])
+        current_app.extensions['reportCache'].put(version, key, *cached)
+    return (version, key) + tuple(cached)
 
-        Reportcolumns = {'MerchantName': 'Merchant Name', 'TransactionDate': 'Total Count', 'SaleAmount': 'Sale Amount'}
-        Reportcolumns = {**Reportcolumns, **{x:x for x in CardSchemes}}
+def reportFilters():
+    #Optional filters, from / to as YYYY-MM or YYYY-MM-DD and one or more merchant names
+    return {'from': request.args.get('from', ''), 'to': request.args.get('to', ''), 'merchant': [x for x in request.args.getlist('merchant') if x != '']}
 
-        data = data.groupby(['Year-Month', 'MerchantName'])[[x for x in Reportcolumns.keys()]].sum().reset_index()
+@bp.route('/report')
+@LoggedinDecorator
+def report():
+    filters = reportFilters()
 
-        payload = {}
-        for year in years:
-            payload[year] = data[data['Year-Month'] == year].drop(['Year-Month'], axis=1)[[x for x in Reportcolumns.keys()]]
-            payload[year]['SaleAmount'] = payload[year]['SaleAmount'].round(2)
-            payload[year] = payload[year].values.tolist()
+    try:
+        version, key, Reportcolumns, data = cachedReport(filters)
+    except ValueError as e:
+        flash(str(e))
+        return render_template('report.html', data={'No Data': [[]]}, Reportcolumns=[], filters=filters)
 
-        data['SaleAmount'] = data['SaleAmount'].round(2)
-        data = data.rename(Reportcolumns, axis=1)
-        data.to_csv(script_path + 'export/report.csv', index=False)
+    if len(data) == 0:
+        return render_template('report.html', data={'No Data': [[]]}, Reportcolumns=[], filters=filters)
+    else:
+        #Rows come back sorted by Year-Month, split them into one table per period
+        with metrics.phase('report_group', len(data)):
+            payload = {}
+            for row in data:
+                payload.setdefault(row[0], []).append(list(row[1:]))
 
-        return render_template('report.html', data=payload, Reportcolumns=[x for x in Reportcolumns.values()])
+        return render_template('report.html', data=payload, Reportcolumns=Reportcolumns[1:], filters=filters)
 
-@app.route('/report/download')
+@bp.route('/report/download')
 @LoggedinDecorator
 def reportDownload():
+    #Same filters as /report, the csv is written once per data version
+    filters = reportFilters()
     try:
-        return send_from_directory(directory=script_path + 'export/', filename='report.csv', as_attachment=True)
-    except:
-        flash("Error: Could not find report summary file")
-        return render_template('report.html', data={'No Data': [[]]}, Reportcolumns=[])
+        version, key, Reportcolumns, data = cachedReport(filters)
+        with metrics.phase('report_csv', len(data)):
+            path = current_app.extensions['reportCache'].csvPath(version, key, Reportcolumns, data)
+        return send_from_directory(os.path.dirname(path), os.path.basename(path), as_attachment=True)
+    except ValueError as e:
+        flash("Error: Could not create report summary file, {}".format(e))
+        return render_template('report.html', data={'No Data': [[]]}, Reportcolumns=[], filters=filters)
+
 
 
-@app.route('/merchants', methods=['GET', 'POST'])
+@bp.route('/merchants', methods=['GET', 'POST'])
 @LoggedinDecorator
 def merchants():
     submit = request.form.get("NewMerchant")
@@ -183,27 +314,24 @@ def merchants():
 
 
     if submit != None and submit != "":
-        query_db("""INSERT INTO Merchants (name) VALUES ('{}');""".format(submit), insert=True)
-
+        query_db("""INSERT INTO Merchants (name) VALUES (?);""", (submit,), insert=True)
+        bumpAllowlists(get_db())
 
-    if delete != None and delete != "":
-        for item in delete:
-            query_db("""DELETE FROM Merchants WHERE name = '{}';""".format(item), insert=True)
 
+    if delete != None and len(delete) > 0:
+        deleted = delete_in('Merchants', 'name', delete)
+        bumpAllowlists(get_db())
+        flash('Deleted {} merchants'.format(deleted))
 
-    Merchants = [x[0] for x in query_db('Select * from Merchants')]
-    if len(Merchants) > 250:
-        Currentpage = request.args.get('page')
-        Currentpage = 0 if (Currentpage == None or Currentpage == "") else Currentpage
-        totalPages = math.ceil(len(Merchants) / 250)
-        Merchants = Merchants[250*int(Currentpage):250*int(Currentpage)+250]
-        pageDic = {}
-        for page in range(0, totalPages):
-            pageDic[page] = '/merchants?page=' + str(page)
 
-
-    else:
-        pageDic = {}
+    #Keyset paging, each page continues after the last name of the previous one
+    after = request.args.get('after', '')
+    Merchants, nextAfter = merchantPage(get_db(), after, 250)
+    pageDic = {}
+    if after != '':
+        pageDic['First page'] = url_for('.merchants')
+    if nextAfter is not None:
+        pageDic['Next page'] = url_for('.merchants', after=nextAfter)
 
     #print(Merchants)
 
@@ -213,7 +341,7 @@ def merchants():
 
 
 
-@app.route('/merchants/upload', methods=['POST'])
+@bp.route('/merchants/upload', methods=['POST'])
 @LoggedinDecorator
 def merchantsUpload(): 
     def allowed_file(filename):
@@ -224,61 +352,63 @@ def merchantsUpload():
             # check if the post request has the file part
             if 'file' not in request.files:
                 flash('No file part')
-                return redirect(url_for('merchants'))
+                return redirect(url_for('.merchants'))
             file = request.files['file']
             # if user does not select file, browser also
             # submit an empty part without filename
             if file.filename == '':
                 flash('No selected file.')
-                return redirect(url_for('merchants'))
+                return redirect(url_for('.merchants'))
 
             if file and allowed_file(file.filename):
+                import pandas as pd
                 filename = secure_filename(file.filename).strip().replace(" ", "_")
 
                 #Save file
-                file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+                file.save(os.path.join(current_app.config['UPLOAD_FOLDER'], filename))
 
                 if filename.split(".")[1] == 'xlsx':
-                    df = pd.read_excel(script_path + "uploads/" + filename)
+                    df = pd.read_excel(os.path.join(current_app.config['UPLOAD_FOLDER'], filename))
                   
 
 
                 elif filename.split(".")[1] == 'ods':
                     #sheet_name = "sheet1"
-                    print(script_path + 'uploads/' + filename)
-                    df = read_ods(script_path + 'uploads/' + filename, 0)
+                    print(os.path.join(current_app.config['UPLOAD_FOLDER'], filename))
+                    from pandas_ods_reader import read_ods
+                    df = read_ods(os.path.join(current_app.config['UPLOAD_FOLDER'], filename), 0)
                    
 
                 elif filename.split(".")[1] == 'csv':
-                    print(script_path + 'uploads/' + filename)
-                    df = pd.read_csv(script_path + 'uploads/' + filename)
+                    print(os.path.join(current_app.config['UPLOAD_FOLDER'], filename))
+                    df = pd.read_csv(os.path.join(current_app.config['UPLOAD_FOLDER'], filename))
                 
 
 
                 else:
                     flash('Error: Bad file extension.')
-                    return redirect(url_for('merchants'))
+                    return redirect(url_for('.merchants'))
 
 
-                os.remove(script_path + 'uploads/' + filename)
+                os.remove(os.path.join(current_app.config['UPLOAD_FOLDER'], filename))
 
                 #apply filtering
-                Merchants = [x[0] for x in query_db('Select * from Merchants')]
+                Merchants, CardSchemes = getAllowlists(get_db(), current_app.config['DATABASE'])
 
                 if ('MerchantName' not in df.columns):
                     flash('Could not find MerchantName column in the data')
-                    return redirect(url_for('merchants'))
+                    return redirect(url_for('.merchants'))
 
                 df = [x for x in df['MerchantName'].unique() if x not in Merchants]
 
                 if len(df) == 0:
                     flash('No new merchants found')
-                    return redirect(url_for('merchants'))
+                    return redirect(url_for('.merchants'))
 
-                df = pd.DataFrame(df, columns=['name'])
-                
                 try:
-                    df.to_sql('Merchants', index=False, if_exists = 'append', con=get_db(DATABASE = DATABASE))
+                    #Inserted with the version bump in one transaction
+                    query_many('INSERT INTO Merchants (name) VALUES (?);', [(str(x),) for x in df if pd.notnull(x)], con=get_db())
+                    bumpAllowlists(get_db())
                     logging.info("Successfully added merchants from file ({}) to a database".format(filename))
                     flash('Success. Added merchants from a file')
 
@@ -289,29 +419,29 @@ def merchantsUpload():
                 #for row in df.iterrows():
                 #    print(", ".join(["""'""" + str(row[x]) + """'""" for x in columns]))
                 #    print("""INSERT INTO data ({}) VALUES ({});""".format(", ".join([x for x in columns]), ", ".join(["""'""" + row[x] + """'""" for x in columns])))
-                #    query_db("""INSERT INTO data ({}) VALUES ({});""".format(", ".join([x for x in columns]), ", ".join(["""'""" + row[x] + """'""" for x in columns])), insert=True, DATABASE = DATABASE_TXN)
+                #    query_db("""INSERT INTO data ({}) VALUES ({});""".format(", ".join([x for x in columns]), ", ".join(["""'""" + row[x] + """'""" for x in columns])), insert=True, DATABASE = current_app.config['DATABASE_TXN'])
 
 
 
                 #Uploading
                 del df
 
-                return redirect(url_for('merchants'))
+                return redirect(url_for('.merchants'))
         except:
             flash('Parsing error... Please contact donatas.svilpa@gmail.com, or try different file type')
-            return redirect(url_for('merchants'))
+            return redirect(url_for('.merchants'))
 
 
         else:
             flash('Bad file extension.')
-            return redirect(url_for('merchants'))
+            return redirect(url_for('.merchants'))
 
 
 
 
 
 
-@app.route('/cardSchemes', methods=['GET', 'POST'])
+@bp.route('/cardSchemes', methods=['GET', 'POST'])
 @LoggedinDecorator
 def cardSchemes():
     submit = request.form.get("NewCardScheme")
@@ -319,12 +449,13 @@ def cardSchemes():
 
 
     if submit != None and submit != "":
-        query_db("""INSERT INTO CardSchemes (name) VALUES ('{}');""".format(submit), insert=True)
+        query_db("""INSERT INTO CardSchemes (name) VALUES (?);""", (submit,), insert=True)
+        bumpAllowlists(get_db())
 
 
-    if delete != None and delete != "":
-        for item in delete:
-            query_db("""DELETE FROM CardSchemes WHERE name = '{}';""".format(item), insert=True)
+    if delete != None and len(delete) > 0:
+        delete_in('CardSchemes', 'name', delete)
+        bumpAllowlists(get_db())
 
 
     CardSchemes = [x[0] for x in query_db('Select * from CardSchemes')]
@@ -337,7 +468,7 @@ def cardSchemes():
 
 
 
-@app.route("/export", methods=['GET', 'POST'])
+@bp.route("/export", methods=['GET', 'POST'])
 @LoggedinDecorator
 def export():
 
@@ -346,122 +477,174 @@ def export():
     #fileSelected = request.form.get("fileSelected")
     fileSelected = 'All'
 
-    if delete != None and delete != "":
-        for item in delete:
-            exportFilesToBeRemoved = [x for x in query_db('Select * from exportHistory where exportId = {}'.format(item), DATABASE = DATABASE_TXN)]
-            for file in exportFilesToBeRemoved:
-                try:
-                    os.remove(script_path + "export/" + file[3])
-                    logging.info("Removed file {}".format(file))
-                except:
-                    logging.info("Removed file FAILED {}".format(file[3]))
-
-            query_db("""DELETE FROM exportHistory WHERE exportId = '{}';""".format(item), insert=True, DATABASE = DATABASE_TXN)
-            logging.info("Deleted from exportHistory file {}".format(file[3]))
+    if delete != None and len(delete) > 0:
+        exportFilesToBeRemoved = []
+        for batch in batches(delete):
+            clause, args = where_in('exportId', batch)
+            exportFilesToBeRemoved += [x for x in query_db('Select * from exportHistory where {}'.format(clause), args, DATABASE = current_app.config['DATABASE_TXN'])]
+        #Files are only removed once their rows are gone
+        try:
+            with db.requestWriter(current_app.config['DATABASE_TXN']):
+                deleted = delete_in('exportHistory', 'exportId', delete, DATABASE = current_app.config['DATABASE_TXN'])
+        except db.WriterBusy as e:
+            get_db(DATABASE = current_app.config['DATABASE_TXN']).rollback()
+            exportFilesToBeRemoved = []
+            flash('{}, exports were not deleted. Try again when it has finished.'.format(e))
+        else:
+            logging.info("Deleted {} rows from exportHistory".format(deleted))
+        for file in exportFilesToBeRemoved:
+            try:
+                os.remove(current_app.config['EXPORT_FOLDER'] + file[3])
+                logging.info("Removed file {}".format(file))
+            except:
+                logging.info("Removed file FAILED {}".format(file[3]))
 
     if submit != None and submit != "":
-        try:
-            exportTimestamp = datetime.datetime.now()
-            files = []
-            zipExportFile = "export_" + str(exportTimestamp) + ".zip"
-
-            if fileSelected == "All":
-                Txn = pd.DataFrame([x for x in query_db('Select * from data', DATABASE = DATABASE_TXN)], columns = columns)
-            else:
-                Txn = pd.DataFrame([x for x in query_db('Select * from data where UploadId = {}'.format(fileSelected), DATABASE = DATABASE_TXN)], columns = columns)
-
-            Txn['TxnDate'] = Txn.apply(lambda x: pd.to_datetime(x['TransactionDate']).strftime("%Y-%m"), axis=1)
-            RowLen = Txn.shape[0]
-
-            #Save filess by merchant
-            for merchant in Txn['MerchantName'].unique():
-                for TxnDate in Txn[Txn['MerchantName'] == merchant]['TxnDate'].unique():
-                    file_to_save_to = merchant + "_" + TxnDate + ".csv"
-                    Txn[(Txn['MerchantName'] == merchant) & (Txn['TxnDate'] == TxnDate)].drop(['UploadTime', 'UploadId', 'TxnDate'], axis=1).to_csv(script_path + "export/" + file_to_save_to, index=False)
-                    files.append({"filePath": script_path + "export/" + file_to_save_to, 'arcName': file_to_save_to})
-
-            #Zip all files
-            # writing files to a zipfile 
-            with ZipFile(script_path + "export/" + zipExportFile,'w') as zip: 
-                # writing each file one by one 
-                for file in files: 
-                    zip.write(file['filePath'], file['arcName']) 
-            logging.info("Zip {} created".format(file['arcName']))
-          
-
-            #Remove old csvs and keep zip file
-            for file in files:
-                os.remove(file['filePath'])
-
-
-            #Add line within export history
-            #Get Max exportID if exist
-            exportId = query_db('Select max(exportId) from exportHistory', DATABASE = DATABASE_TXN)
-            exportId = 0 if exportId[0][0] == None else exportId[0][0] + 1
-
-            query_db("""INSERT INTO exportHistory (exportDate, success, len, filename, exportId) VALUES ('{}', '{}', '{}', '{}', '{}');""".format(str(exportTimestamp), 'True', RowLen, zipExportFile, exportId), insert=True, DATABASE = DATABASE_TXN)
-            logging.info("Export record generated")
-            if fileSelected == "All":
-                query_db("""DELETE FROM data;""" , insert=True, DATABASE = DATABASE_TXN)
-                logging.info("All transaction data in local storage deleted")
-                query_db("""DELETE FROM UploadHistory;""" , insert=True, DATABASE = DATABASE_TXN)
-                logging.info("All data in UploadHistory deleted")
-            else:
-                query_db("""DELETE FROM data where UploadID = {};""".format(fileSelected) , insert=True, DATABASE = DATABASE_TXN)
-                logging.info("All transaction data in local storage deleted from Upload fileId {}".format(fileSelected))
-                query_db("""DELETE FROM UploadHistory where UploadId = {};""".format(fileSelected) , insert=True, DATABASE = DATABASE_TXN)
-                logging.info("All data in UploadHistory deleted from upload fileID {}".format(fileSelected))
-
-
-
-            flash('File exported successfully')
-        except:
-            logging.info('Export error')
-            flash('Export error')
+        #Zipping and purging run as a background job, see /jobs/<id>
+        jobId = submitJob(current_app.config['JOBS_DATABASE'], current_app.config['DATABASE_TXN'], 'export', fileSelected, runExport, (current_app.config['EXPORT_FOLDER'], columns, fileSelected, current_app.config['EXPORT_PROCESSES'], current_app.config['EXPORT_COMPRESSION_LEVEL'], current_app.config['EXPORT_ZIP64'], current_app.config['ARCHIVE_FOLDER']), profile=profilePath('export_job'))
+        logging.info("Export queued as job {}".format(jobId))
+        if wantsJson():
+            return jsonify({'job': jobId, 'url': url_for('.job', jobId=jobId)}), 202
+        flash('Export queued as job {}'.format(jobId))
 
-    exportHistory = [x for x in query_db('Select * from exportHistory', DATABASE = DATABASE_TXN)]
+    exportHistory = [x for x in query_db('Select * from exportHistory', DATABASE = current_app.config['DATABASE_TXN'])]
 
     #Import file list
-    importHistory = [x for x in query_db('Select * from UploadHistory', DATABASE = DATABASE_TXN)]
+    importHistory = [x for x in query_db('Select * from UploadHistory', DATABASE = current_app.config['DATABASE_TXN'])]
 
-    return render_template('export.html', exportHistory=exportHistory, importHistory=importHistory)
+    return render_template('export.html', exportHistory=exportHistory, importHistory=importHistory, jobs=recentJobs(current_app.config['JOBS_DATABASE'], 'export'))
 
 
-@app.route("/exportDownload")
+@bp.route("/exportDownload")
 @LoggedinDecorator
 def exportDownload():
     file = request.args.get('file')
-    print(script_path + 'export/' + file)
+    print(current_app.config['EXPORT_FOLDER'] + file)
 
-    #exportHistory = [x for x in query_db('Select * from exportHistory', DATABASE = DATABASE_TXN)]
+    #exportHistory = [x for x in query_db('Select * from exportHistory', DATABASE = current_app.config['DATABASE_TXN'])]
     #return render_template('export.html', exportHistory=exportHistory)
-    return send_from_directory(directory=script_path + 'export/', filename=file, as_attachment=True)
+    return send_from_directory(directory=current_app.config['EXPORT_FOLDER'], filename=file, as_attachment=True)
 
 
 
 
-@app.route("/excel", methods=['GET', 'POST'])
+@bp.route("/excel", methods=['GET', 'POST'])
 @LoggedinDecorator
 def excel():
 
     delete = request.form.getlist("defaultCheck1")
 
-    if delete != None and delete != "":
-        for item in delete:
-            query_db("""DELETE FROM data WHERE UploadId = {};""".format(item), insert=True, DATABASE = DATABASE_TXN)
-            query_db("""DELETE FROM UploadHistory WHERE UploadId = {};""".format(item), insert=True, DATABASE = DATABASE_TXN)
+    if delete != None and len(delete) > 0:
+        #Roll back the summary and drop every selected upload in a single transaction
+        con = get_db(DATABASE = current_app.config['DATABASE_TXN'])
+        #Reject csvs of the selected uploads, removed once the delete is committed
+        rejectFiles = []
+        for batch in batches(delete):
+            clause, args = where_in('UploadId', batch)
+            rejectFiles += [x[0] for x in con.execute('SELECT rejectFile FROM UploadHistory WHERE rejectFile IS NOT NULL AND {};'.format(clause), args)]
+        try:
+            with db.requestWriter(current_app.config['DATABASE_TXN']):
+                deleted = 0
+                for batch in batches(delete):
+                    summaryRemove(con, *where_in('UploadId', batch), commit=False)
+                    deleted += deleteRows(con, *where_in('UploadId', batch))
+                uploads = delete_in('UploadHistory', 'UploadId', delete, con = con)
+                bumpDataVersion(con)
+                con.commit()
+        except db.WriterBusy as e:
+            con.rollback()
+            flash('{}, uploads were not deleted. Try again when it has finished.'.format(e))
+        except:
+            con.rollback()
+            raise
+        else:
+            for path in rejectFiles:
+                if os.path.exists(path):
+                    os.remove(path)
+            logging.info("Deleted {} uploads, {} transactions".format(uploads, deleted))
+            flash('Deleted {} uploads, {} transactions'.format(uploads, deleted))
 
 
 
-    History = [x for x in query_db('Select * from UploadHistory', DATABASE = DATABASE_TXN)]
-    return render_template('excel.html', History=History)
+    History = [x for x in query_db('Select * from UploadHistory', DATABASE = current_app.config['DATABASE_TXN'])]
+    return render_template('excel.html', History=History, jobs=recentJobs(current_app.config['JOBS_DATABASE'], 'upload'))
 
 
+@bp.route("/excel/rejects/<int:UploadId>")
+@LoggedinDecorator
+def rejects(UploadId):
+    #Reject csv of an upload, the rows that failed validation with their reasons
+    row = query_db('SELECT rejectFile FROM UploadHistory WHERE UploadId = ?;', (UploadId,), one=True, DATABASE = current_app.config['DATABASE_TXN'])
+    if row is None or row[0] is None or not os.path.exists(row[0]):
+        abort(404)
+    return send_from_directory(os.path.dirname(row[0]), os.path.basename(row[0]), as_attachment=True)
+
 
-@app.route("/ExcelUpload", methods=['POST'])
+@bp.route("/transactions")
+@LoggedinDecorator
+def transactions():
+    #Stored transactions in (TransactionDate, TransactionId) order, one indexed page at a time
+    filters = {x: request.args.get(x, '') for x in ['merchant', 'scheme', 'upload', 'from', 'to']}
+    after = request.args.get('after', '')
+    try:
+        limit = int(request.args.get('limit', PAGE_SIZE))
+        rows, nextCursor = transactionPage(get_db(DATABASE = current_app.config['DATABASE_TXN']), columns, filters, after, limit)
+    except ValueError as e:
+        if wantsJson():
+            return jsonify({'error': str(e)}), 400
+        flash(str(e))
+        rows, nextCursor = [], None
+
+    nextUrl = url_for('.transactions', after=nextCursor, **{x: y for x, y in filters.items() if y != ''}) if nextCursor else None
+    if wantsJson():
+        return jsonify({'rows': [dict(zip(columns + ['TransactionId'], x)) for x in rows], 'next': nextCursor, 'nextUrl': nextUrl})
+    return render_template('transactions.html', columns=columns + ['TransactionId'], rows=rows, filters=filters, nextUrl=nextUrl)
+
+
+@bp.route("/search")
+@LoggedinDecorator
+def search():
+    #Single transactions by ClientName / AuthMessage / TerminalId text and card number suffix, best match first
+    terms = {x: request.args.get(x, '') for x in ['q', 'card']}
+    rows = []
+    if terms['q'] or terms['card'] or wantsJson():
+        try:
+            limit = int(request.args.get('limit', SEARCH_LIMIT))
+            rows = searchTransactions(get_db(DATABASE = current_app.config['DATABASE_TXN']), columns, terms['q'], terms['card'], limit)
+        except ValueError as e:
+            if wantsJson():
+                return jsonify({'error': str(e)}), 400
+            flash(str(e))
+
+    if wantsJson():
+        return jsonify({'rows': [dict(zip(columns + ['TransactionId'], x)) for x in rows]})
+    return render_template('search.html', columns=columns + ['TransactionId'], rows=rows, terms=terms)
+
+
+@bp.route("/metrics")
+def metricsView():
+    #Prometheus scrape target, left outside the login so a scraper can reach it
+    if not metrics.enabled():
+        abort(404)
+    return metrics.renderPrometheus(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
+@bp.route("/jobs/<int:jobId>")
+@LoggedinDecorator
+def job(jobId):
+    #Phase, rows processed and throughput of a background upload / export
+    state = getJob(current_app.config['JOBS_DATABASE'], jobId)
+    if state is None:
+        abort(404)
+    return jsonify(state)
+
+
+
+@bp.route("/ExcelUpload", methods=['POST'])
 @LoggedinDecorator
 def ExcelUpload():
-    
+    from ingest import runUpload, runBatchUpload
+
     def allowed_file(filename):
         return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
@@ -470,139 +653,71 @@ def ExcelUpload():
             # check if the post request has the file part
             if 'file' not in request.files:
                 flash('No file part')
-                return redirect(url_for('excel'))
+                return redirect(url_for('.excel'))
             file = request.files['file']
             # if user does not select file, browser also
             # submit an empty part without filename
             if file.filename == '':
                 flash('No selected file.')
-                return redirect(url_for('excel'))
+                return redirect(url_for('.excel'))
+
+            #Several files or a zip archive go to a batch upload job
+            files = [x for x in request.files.getlist('file') if x.filename != '']
+            if len(files) > 1 or (files and files[0].filename.rsplit('.', 1)[-1].lower() == 'zip'):
+                if not all(allowed_file(x.filename) or x.filename.rsplit('.', 1)[-1].lower() == 'zip' for x in files):
+                    flash('Bad file extension.')
+                    return redirect(url_for('.excel'))
+
+                saved = []
+                for item in files:
+                    filename = secure_filename(item.filename).strip().replace(" ", "_")
+                    path = os.path.join(current_app.config['UPLOAD_FOLDER'], uuid.uuid4().hex + "_" + filename)
+                    item.save(path)
+                    saved.append((path, filename, filename.rsplit(".", 1)[1].lower()))
+
+                CardSchemes = getAllowlists(get_db(), current_app.config['DATABASE'])[1]
+                Merchants = getMerchantMatcher(get_db(), current_app.config['DATABASE'], current_app.config['MERCHANT_MATCH_THRESHOLD'])
+                name = saved[0][1] if len(saved) == 1 else '{} files'.format(len(saved))
+                jobId = submitJob(current_app.config['JOBS_DATABASE'], current_app.config['DATABASE_TXN'], 'upload', name, runBatchUpload, (saved, columns, Merchants, CardSchemes, ALLOWED_EXTENSIONS, current_app.config['UPLOAD_PROCESSES'], current_app.config['REJECT_FOLDER']), profile=profilePath('upload_job'))
+                logging.info("Batch upload of {} queued as job {}".format(name, jobId))
+                if wantsJson():
+                    return jsonify({'job': jobId, 'url': url_for('.job', jobId=jobId)}), 202
+                flash('Batch upload of {} queued as job {}'.format(name, jobId))
+                return redirect(url_for('.excel'))
 
             if file and allowed_file(file.filename):
                 filename = secure_filename(file.filename).strip().replace(" ", "_")
 
-                #Save file
-                file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-
-                if filename.split(".")[1] == 'xlsx':
-                    df = pd.read_excel(script_path + "uploads/" + filename)
-                  
-
-
-                elif filename.split(".")[1] == 'ods':
-                    #sheet_name = "sheet1"
-                    print(script_path + 'uploads/' + filename)
-                    df = read_ods(script_path + 'uploads/' + filename, 0)
-                   
-
-                elif filename.split(".")[1] == 'csv':
-                    print(script_path + 'uploads/' + filename)
-                    df = pd.read_csv(script_path + 'uploads/' + filename)
-                
-
-
-                else:
-                    flash('Error: Bad file extension.')
-                    return redirect(url_for('excel'))
-
-
-                os.remove(script_path + 'uploads/' + filename)
-
-                #apply filtering
-                CardSchemes = [x[0] for x in query_db('Select * from CardSchemes')]
-                Merchants = [x[0] for x in query_db('Select * from Merchants')]
+                extension = filename.rsplit(".", 1)[1].lower()
 
-                if ('MerchantName' not in df.columns) or ('CardScheme' not in df.columns):
-                    flash('Could not find MerchantName or CardScheme columns in the data')
-                    return redirect(url_for('excel'))
-
-                df = df[df['MerchantName'].isin(Merchants)]
-                df = df[df['CardScheme'].isin(CardSchemes)]
-
-
-                if df.shape[0] == 0:
-                    flash('No data to upload after applying filtering')
-                    return redirect(url_for('excel'))
-
-                #check if all columns exist, with tolerance for 2 missing
-                assert len(columns) + 2 >= len([x for x in df.columns if x in columns]) and len(columns) >= len([x for x in df.columns if x in columns]) - 2
-
-                #add empty columns
-                for col in columns:
-                    if col not in df.columns:
-                        df[col] = None
-
-
-                #df.to_sql('data', con=get_db(DATABASE = DATABASE_TXN))
-                #UploadHistory(uploadtime timestamp, filename text, success boolean)
-
-                #Set timestamp
-                timestamp = datetime.datetime.now()
-                df['UploadTime'] = str(timestamp)
-
-                #Fix Datatime
-                if filename.split(".")[1] == 'csv':
-                    try:
-                        df['TransactionDate'] = df['TransactionDate'].map(lambda x: pd.to_datetime(str(x), format="%d/%m/%Y %H:%M:%S"))
-                    except:
-                        df['TransactionDate'] = df['TransactionDate'].map(lambda x: pd.to_datetime(str(x), format="%d/%m/%Y %H:%M"))
-                elif filename.split(".")[1] == 'ods':
-                    try:
-                        df['TransactionDate'] = df['TransactionDate'].map(lambda x: pd.to_datetime(str(x), format="%Y/%m/%dT%H:%M:%S"))
-                    except:
-                        df['TransactionDate'] = df['TransactionDate'].map(lambda x: pd.to_datetime(str(x), format="%Y/%m/%dT%H:%M"))
-                elif filename.split(".")[1] == 'xlsx':
-                    try:
-                        df['TransactionDate'] = df['TransactionDate'].map(lambda x: pd.to_datetime(str(x), format="%Y/%m/%d %H:%M:%S"))
-                    except:
-                        df['TransactionDate'] = df['TransactionDate'].map(lambda x: pd.to_datetime(str(x), format="%Y/%m/%d %H:%M"))
-
-
-                #Make sure Sale Amount is proper float, as it might come with semicolons from excel file
-
-                df['SaleAmount'] = df['SaleAmount'].map(lambda x: x.replace(",", ".") if type(x) == str else x)
-                df['SaleAmount'] = df['SaleAmount'].astype(float)
-               
-
-
-
-                #Set Upload id
-                UploadId = query_db('Select max(UploadId) from UploadHistory', DATABASE = DATABASE_TXN)
-                UploadId = 0 if UploadId[0][0] == None else UploadId[0][0] + 1
-                df['UploadId'] = UploadId
-             
-                
-                try:
-                    df.to_sql('data', index=False, if_exists = 'append', con=get_db(DATABASE = DATABASE_TXN))
-                    query_db("""INSERT INTO UploadHistory (uploadtime, filename, success, len, UploadId) VALUES ('{}', '{}', '{}', '{}', '{}');""".format(str(timestamp), filename, "True", str(df.shape[0]), UploadId), DATABASE=DATABASE_TXN, insert=True)
-                    logging.info("Successfully uploaded file ({}) contents to a database".format(filename))
-                    flash('Success')
-
-                except:
-                    query_db("""INSERT INTO UploadHistory (uploadtime, filename, success, len, UploadId) VALUES ('{}', '{}', '{}', '{}', '{}');""".format(str(timestamp), filename, "False", str(df.shape[0]), UploadId), DATABASE=DATABASE_TXN, insert=True)
-                    logging.info('Failed to upload data from file ({}) to a database'.format(filename))
-                    flash('Fail')
-                #Filtering
-                #for row in df.iterrows():
-                #    print(", ".join(["""'""" + str(row[x]) + """'""" for x in columns]))
-                #    print("""INSERT INTO data ({}) VALUES ({});""".format(", ".join([x for x in columns]), ", ".join(["""'""" + row[x] + """'""" for x in columns])))
-                #    query_db("""INSERT INTO data ({}) VALUES ({});""".format(", ".join([x for x in columns]), ", ".join(["""'""" + row[x] + """'""" for x in columns])), insert=True, DATABASE = DATABASE_TXN)
+                #Save file, prefixed so queued uploads with the same name do not overwrite each other
+                path = os.path.join(current_app.config['UPLOAD_FOLDER'], uuid.uuid4().hex + "_" + filename)
+                file.save(path)
 
+                #filtering sets and the merchant matcher, cached until Merchants or CardSchemes change
+                CardSchemes = getAllowlists(get_db(), current_app.config['DATABASE'])[1]
+                Merchants = getMerchantMatcher(get_db(), current_app.config['DATABASE'], current_app.config['MERCHANT_MATCH_THRESHOLD'])
 
+                #Read, filter, normalize and insert the file chunk by chunk in a background job
+                jobId = submitJob(current_app.config['JOBS_DATABASE'], current_app.config['DATABASE_TXN'], 'upload', filename, runUpload, (path, filename, extension, columns, Merchants, CardSchemes, current_app.config['REJECT_FOLDER']), profile=profilePath('upload_job'))
+                logging.info("Upload of file ({}) queued as job {}".format(filename, jobId))
+                if wantsJson():
+                    return jsonify({'job': jobId, 'url': url_for('.job', jobId=jobId)}), 202
+                flash('Upload queued as job {}'.format(jobId))
 
                 #Uploading
-                return redirect(url_for('excel'))
+                return redirect(url_for('.excel'))
         except:
             flash('Parsing error... Please contact donatas.svilpa@gmail.com, or try different file type')
-            return redirect(url_for('excel'))
+            return redirect(url_for('.excel'))
 
 
         else:
             flash('Bad file extension.')
-            return redirect(url_for('excel'))
+            return redirect(url_for('.excel'))
 
 
 
 
 if __name__ == '__main__':
-    app.run(debug=True, host="0.0.0.0")
\ No newline at end of file
+    create_app().run(debug=True, host="0.0.0.0")
\ No newline at end of file
@@ -0,0 +1,146 @@
+#Columnar archive tier for exported transactions.
+#Every export also writes each merchant-month as a compressed parquet file under
+#   archive/YearMonth=<YYYY-MM or undated>/MerchantName=<name>/part-<export timestamp>-<uuid>.parquet
+#so the report can keep covering months that were purged from data.db. Reads are memory mapped,
+#only touch the columns they need and prune on the YearMonth / MerchantName directories.
+#pyarrow is optional, without it exports skip the archive and the report only sees data.db.
+import os
+import logging
+import urllib.parse
+from partitions import UNDATED
+
+FLOAT_COLUMNS = ['SaleAmount', 'DccAmount']
+#Partition keys live in the directory names, not in the files
+PARTITION = ['YearMonth', 'MerchantName']
+
+_missing = []
+
+
+def _arrow():
+    #Lazy import so the app starts without pyarrow, logged once
+    try:
+        import pyarrow
+        import pyarrow.parquet
+        import pyarrow.dataset
+        import pyarrow.compute
+        import pyarrow.fs
+        return pyarrow
+    except ImportError:
+        if not _missing:
+            _missing.append(True)
+            logging.info('pyarrow is not installed, parquet archive is disabled')
+        return None
+
+
+def _partitionDir(folder, merchant, month):
+    return os.path.join(folder, 'YearMonth=' + month, 'MerchantName=' + urllib.parse.quote(merchant, safe=''))
+
+
+class ArchiveWriter():
+    #Receives the export batches as write((merchant, month), rows), rows of the same key arrive together
+    def __init__(self, folder, columns, name, compression='zstd'):
+        #name goes into every file name of this export and must never repeat, unlike exportIds (max + 1 comes
+        #back once the latest exportHistory row is deleted)
+        self.pa = _arrow()
+        self.folder = folder
+        self.columns = columns
+        self.name = name
+        self.compression = compression
+        self.key = None
+        self.writer = None
+        self.file = None
+        self.paths = []
+
+    def _table(self, rows):
+        import pandas as pd
+        pa = self.pa
+        arrays = []
+        for name, values in zip(self.columns, zip(*rows)):
+            if name in FLOAT_COLUMNS:
+                arrays.append(pa.array(pd.to_numeric(pd.Series(values), errors='coerce'), type=pa.float64(), from_pandas=True))
+            elif name == 'TransactionDate':
+                dates = pa.array(values, type=pa.string())
+                try:
+                    arrays.append(dates.cast(pa.timestamp('s')))
+                except pa.ArrowInvalid:
+                    #Undated rows, dates that do not parse are archived as null
+                    arrays.append(pa.compute.strptime(dates, format='%Y-%m-%d %H:%M:%S', unit='s', error_is_null=True))
+            else:
+                arrays.append(pa.array([None if x is None else str(x) for x in values], type=pa.string()))
+        keep = [x for x in self.columns if x not in PARTITION]
+        return pa.Table.from_arrays([arrays[self.columns.index(x)] for x in keep], names=keep)
+
+    def write(self, key, rows):
+        if self.pa is None:
+            return
+        table = self._table(rows)
+        if key != self.key:
+            self._closeWriter()
+            directory = _partitionDir(self.folder, key[0], key[1])
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, 'part-{}.parquet'.format(self.name))
+            #Exclusive create, archived data is never overwritten and abort() only removes files created here
+            self.file = open(path, 'xb')
+            self.paths.append(path)
+            self.key, self.writer = key, self.pa.parquet.ParquetWriter(self.file, table.schema, compression=self.compression)
+        self.writer.write_table(table)
+
+    def _closeWriter(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def close(self):
+        self._closeWriter()
+        if self.paths:
+            logging.info("Archived {} merchant-month partitions for export {}".format(len(self.paths), self.name))
+
+    def abort(self):
+        #Export failed, drop every file this export wrote
+        self._closeWriter()
+        for path in self.paths:
+            if os.path.exists(path):
+                os.remove(path)
+        self.paths = []
+
+
+def archiveRollup(folder, start=None, end=None, merchants=None):
+    #(YearMonth, MerchantName, CardScheme, count, amount) of archived rows within the report filters,
+    #start / end are 'YYYY-MM' or 'YYYY-MM-DD' as validated by reporting.parseFilter
+    pa = _arrow()
+    if pa is None or not os.path.isdir(folder) or not os.listdir(folder):
+        return []
+    import pandas as pd
+    ds, pc = pa.dataset, pa.compute
+
+    partitioning = ds.partitioning(pa.schema([('YearMonth', pa.string()), ('MerchantName', pa.string())]), flavor='hive')
+    dataset = ds.dataset(folder, format='parquet', partitioning=partitioning, filesystem=pa.fs.LocalFileSystem(use_mmap=True))
+
+    conditions = []
+    if start or end:
+        #Undated rows fall outside any range, as in the report
+        conditions.append(ds.field('YearMonth') != UNDATED)
+    if start:
+        conditions.append(ds.field('YearMonth') >= start[:7])
+        if len(start) == 10:
+            conditions.append(ds.field('TransactionDate') >= pa.scalar(pd.Timestamp(start), type=pa.timestamp('s')))
+    if end:
+        conditions.append(ds.field('YearMonth') <= end[:7])
+        if len(end) == 10:
+            conditions.append(ds.field('TransactionDate') < pa.scalar(pd.Timestamp(end) + pd.Timedelta(days=1), type=pa.timestamp('s')))
+    if merchants:
+        conditions.append(ds.field('MerchantName').isin(merchants))
+    condition = None
+    for x in conditions:
+        condition = x if condition is None else condition & x
+
+    table = dataset.to_table(columns=['YearMonth', 'MerchantName', 'CardScheme', 'SaleAmount'], filter=condition)
+    if table.num_rows == 0:
+        return []
+    rollup = table.group_by(['YearMonth', 'MerchantName', 'CardScheme']).aggregate(
+        [('SaleAmount', 'count', pc.CountOptions(mode='all')), ('SaleAmount', 'sum')])
+    return [(x['YearMonth'], x['MerchantName'], x['CardScheme'], x['SaleAmount_count'], x['SaleAmount_sum'] or 0.0)
+            for x in rollup.to_pylist()]
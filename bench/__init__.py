@@ -0,0 +1 @@
+#Benchmarks for the upload, report and export paths, see bench/run.py
@@ -0,0 +1,33 @@
+#Side by side comparison of two bench/run.py result files.
+#   python3 -m bench.compare bench/results/<old>.json bench/results/<new>.json
+import sys
+import json
+
+
+def _phases(run):
+    return {(case['size'], case['format'], name): values for case in run['cases'] for name, values in case['phases'].items()}
+
+
+def compare(old, new):
+    #Yields (size, format, phase, old seconds, new seconds, change %) for phases present in both runs
+    before, after = _phases(old), _phases(new)
+    for key in sorted(set(before) & set(after)):
+        a, b = before[key]['seconds'], after[key]['seconds']
+        yield key + (a, b, round((b - a) / a * 100, 1) if a else None)
+
+
+def main():
+    if len(sys.argv) != 3:
+        print('usage: python3 -m bench.compare OLD.json NEW.json')
+        sys.exit(2)
+    with open(sys.argv[1]) as f:
+        old = json.load(f)
+    with open(sys.argv[2]) as f:
+        new = json.load(f)
+    print('{} -> {}'.format((old['commit'] or '?')[:12], (new['commit'] or '?')[:12]))
+    for size, extension, phase, a, b, change in compare(old, new):
+        print('{:>5} {:<5} {:<12} {:>9.3f}s {:>9.3f}s {:>+7.1f}%'.format(size, extension, phase, a, b, change or 0.0))
+
+
+if __name__ == '__main__':
+    main()
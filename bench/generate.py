@@ -0,0 +1,203 @@
+#Synthetic transaction files in the upload `columns` schema, written as csv, xlsx or ods.
+#Rows are produced one at a time and written straight into the file (xlsx / ods xml is streamed
+#into the zip entry), so 10M row files are generated in constant memory.
+#   python3 -m bench.generate --sizes 10k,100k --formats csv,xlsx,ods --merchants 50 --schemes 4
+import os
+import csv
+import random
+import zipfile
+import datetime
+import argparse
+from xml.sax.saxutils import escape
+
+COLUMNS = ['MerchantName', 'ClientName', 'TransactionDate', 'TransactionType', 'DataEntryMethod', 'CurrencyCode',
+           'DccCurrencyCode', 'SaleAmount', 'DccAmount', 'CardNumber', 'AuthMessage', 'TerminalId', 'CardScheme',
+           'TransactionMode', 'ExpiryDate', 'ResponseCode']
+
+SIZES = {'10k': 10000, '100k': 100000, '1M': 1000000, '10M': 10000000}
+FORMATS = ['csv', 'xlsx', 'ods']
+SCHEMES = ['VISA', 'MC', 'AMEX', 'DINERS', 'JCB', 'UNIONPAY', 'DISCOVER', 'MAESTRO']
+START = datetime.datetime(2019, 1, 1)
+#Transactions are spread over this many days from START
+DAYS = 365
+XLSX_EPOCH = datetime.datetime(1899, 12, 30)
+DATA_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+def merchantNames(count):
+    return ['Merchant {:04d}'.format(x) for x in range(count)]
+
+
+def schemeNames(count):
+    return SCHEMES[:count] + ['SCHEME{:02d}'.format(x) for x in range(len(SCHEMES), count)]
+
+
+def fileName(size, extension, merchants, schemes):
+    return 'transactions_{}_m{}_s{}.{}'.format(size, merchants, schemes, extension)
+
+
+def transactions(rows, merchants=50, schemes=4, seed=1):
+    #Yields rows in COLUMNS order, TransactionDate as datetime and SaleAmount / DccAmount as float or None
+    r = random.Random(seed)
+    merchantList = merchantNames(merchants)
+    schemeList = schemeNames(schemes)
+    for i in range(rows):
+        date = START + datetime.timedelta(seconds=r.randrange(DAYS * 86400))
+        dcc = r.random() < 0.1
+        yield [r.choice(merchantList), 'client{}'.format(r.randrange(rows // 10 + 1)), date, r.choice(['Sale', 'Refund']),
+               r.choice(['Chip', 'Contactless', 'Swipe']), 'EUR', 'USD' if dcc else None, round(r.uniform(1, 500), 2),
+               round(r.uniform(1, 600), 2) if dcc else None, '****{:04d}'.format(r.randrange(10000)), 'AUTH{}'.format(i),
+               'T{}'.format(r.randrange(1, 200)), r.choice(schemeList), r.choice(['Online', 'Offline']),
+               '{:02d}/{:02d}'.format(r.randint(1, 12), r.randint(20, 29)), '00']
+
+
+def _writeCsv(path, rows):
+    #Same layout as the acquirer csv files, day first dates and decimal commas
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(COLUMNS)
+        for row in rows:
+            row[2] = row[2].strftime('%d/%m/%Y %H:%M:%S')
+            row[7] = '{:.2f}'.format(row[7]).replace('.', ',')
+            row[8] = '' if row[8] is None else '{:.2f}'.format(row[8]).replace('.', ',')
+            writer.writerow(['' if x is None else x for x in row])
+
+
+def _column(index):
+    letters = ''
+    index += 1
+    while index:
+        index, rest = divmod(index - 1, 26)
+        letters = chr(65 + rest) + letters
+    return letters
+
+
+XLSX_FILES = {
+    '[Content_Types].xml': '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+        '</Types>',
+    '_rels/.rels': '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>',
+    'xl/workbook.xml': '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Sheet1" sheetId="1" r:id="rId1"/></sheets></workbook>',
+    'xl/_rels/workbook.xml.rels': '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+        '<Relationship Id="rId2" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>'
+        '</Relationships>',
+    #cellXfs 1 is the built in "m/d/yy h:mm" date format used for TransactionDate
+    'xl/styles.xml': '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+        '<fonts count="1"><font><sz val="11"/><name val="Calibri"/></font></fonts>'
+        '<fills count="1"><fill><patternFill patternType="none"/></fill></fills>'
+        '<borders count="1"><border/></borders>'
+        '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+        '<cellXfs count="2"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+        '<xf numFmtId="22" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/></cellXfs>'
+        '</styleSheet>'}
+
+
+def _xlsxCell(ref, value):
+    if value is None:
+        return ''
+    if isinstance(value, datetime.datetime):
+        return '<c r="{}" s="1"><v>{!r}</v></c>'.format(ref, (value - XLSX_EPOCH).total_seconds() / 86400)
+    if isinstance(value, float):
+        return '<c r="{}"><v>{!r}</v></c>'.format(ref, value)
+    return '<c r="{}" t="inlineStr"><is><t>{}</t></is></c>'.format(ref, escape(str(value)))
+
+
+def _writeXlsx(path, rows):
+    letters = [_column(x) for x in range(len(COLUMNS))]
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, content in XLSX_FILES.items():
+            archive.writestr(name, content)
+        with archive.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True) as sheet:
+            sheet.write(b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                        b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>')
+            header = ''.join(_xlsxCell(x + '1', name) for x, name in zip(letters, COLUMNS))
+            sheet.write('<row r="1">{}</row>'.format(header).encode('utf-8'))
+            for number, row in enumerate(rows, 2):
+                cells = ''.join(_xlsxCell('{}{}'.format(x, number), value) for x, value in zip(letters, row))
+                sheet.write('<row r="{}">{}</row>'.format(number, cells).encode('utf-8'))
+            sheet.write(b'</sheetData></worksheet>')
+
+
+ODS_MIMETYPE = 'application/vnd.oasis.opendocument.spreadsheet'
+ODS_MANIFEST = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<manifest:manifest xmlns:manifest="urn:oasis:names:tc:opendocument:xmlns:manifest:1.0" manifest:version="1.2">'
+                '<manifest:file-entry manifest:full-path="/" manifest:media-type="{}"/>'
+                '<manifest:file-entry manifest:full-path="content.xml" manifest:media-type="text/xml"/>'
+                '</manifest:manifest>').format(ODS_MIMETYPE)
+
+
+def _odsCell(value):
+    if value is None:
+        return '<table:table-cell/>'
+    if isinstance(value, datetime.datetime):
+        return '<table:table-cell office:value-type="date" office:date-value="{}"><text:p>{}</text:p></table:table-cell>'.format(
+            value.strftime('%Y-%m-%dT%H:%M:%S'), value.strftime('%Y-%m-%d %H:%M:%S'))
+    if isinstance(value, float):
+        return '<table:table-cell office:value-type="float" office:value="{0!r}"><text:p>{0!r}</text:p></table:table-cell>'.format(value)
+    return '<table:table-cell office:value-type="string"><text:p>{}</text:p></table:table-cell>'.format(escape(str(value)))
+
+
+def _writeOds(path, rows):
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        #mimetype has to be the first entry and stored uncompressed
+        archive.writestr(zipfile.ZipInfo('mimetype'), ODS_MIMETYPE, compress_type=zipfile.ZIP_STORED)
+        archive.writestr('META-INF/manifest.xml', ODS_MANIFEST)
+        with archive.open('content.xml', 'w', force_zip64=True) as content:
+            content.write(b'<?xml version="1.0" encoding="UTF-8"?>\n'
+                          b'<office:document-content xmlns:office="urn:oasis:names:tc:opendocument:xmlns:office:1.0"'
+                          b' xmlns:table="urn:oasis:names:tc:opendocument:xmlns:table:1.0"'
+                          b' xmlns:text="urn:oasis:names:tc:opendocument:xmlns:text:1.0" office:version="1.2">'
+                          b'<office:body><office:spreadsheet><table:table table:name="Sheet1">')
+            content.write('<table:table-row>{}</table:table-row>'.format(''.join(_odsCell(x) for x in COLUMNS)).encode('utf-8'))
+            for row in rows:
+                content.write('<table:table-row>{}</table:table-row>'.format(''.join(_odsCell(x) for x in row)).encode('utf-8'))
+            content.write(b'</table:table></office:spreadsheet></office:body></office:document-content>')
+
+
+WRITERS = {'csv': _writeCsv, 'xlsx': _writeXlsx, 'ods': _writeOds}
+
+
+def generate(path, rows, extension, merchants=50, schemes=4, seed=1):
+    #Writes rows transactions to path, the same seed always gives the same rows whatever the format
+    WRITERS[extension](path, transactions(rows, merchants, schemes, seed))
+    return path
+
+
+def dataFile(size, extension, merchants=50, schemes=4, folder=DATA_FOLDER):
+    #Path of a generated file, created on first use
+    path = os.path.join(folder, fileName(size, extension, merchants, schemes))
+    if not os.path.exists(path):
+        os.makedirs(folder, exist_ok=True)
+        generate(path + '.part', SIZES[size], extension, merchants, schemes)
+        os.rename(path + '.part', path)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic transaction files')
+    parser.add_argument('--sizes', default='10k', help='comma separated, any of ' + ', '.join(SIZES))
+    parser.add_argument('--formats', default='csv', help='comma separated, any of ' + ', '.join(FORMATS))
+    parser.add_argument('--merchants', type=int, default=50)
+    parser.add_argument('--schemes', type=int, default=4)
+    parser.add_argument('--out', default=DATA_FOLDER)
+    options = parser.parse_args()
+    for size in options.sizes.split(','):
+        for extension in options.formats.split(','):
+            print(dataFile(size, extension, options.merchants, options.schemes, options.out))
+
+
+if __name__ == '__main__':
+    main()
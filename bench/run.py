@@ -0,0 +1,220 @@
+#Benchmark runner for the upload, report and export hot paths.
+#Every (size, format) case runs in a fresh python process against a scratch copy of the app,
+#so peak RSS and databases are not shared between cases. Endpoints are driven through the Flask
+#test client, background jobs are polled through /jobs/<id> like the browser does.
+#   python3 -m bench.run --sizes 10k,100k --formats csv,xlsx --out bench/results/<name>.json
+#Results hold, per phase: wall seconds, rows/sec, the phase's own peak RSS, the bytes the process read and
+#wrote through system calls (every file, upload and zip included, page cache hits too, so not sqlite page I/O,
+#which the sqlite3 module does not expose; reads served from its mmap do not show up at all) and the size
+#of data.db in pages at the end of the phase.
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import platform
+import argparse
+import datetime
+import resource
+import tempfile
+import subprocess
+from bench.generate import dataFile, merchantNames, schemeNames, SIZES, FORMATS, START
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+#What a scratch copy of the app needs
+APP_FILES = ['templates', 'static']
+
+
+def _copyApp(workdir):
+    for name in os.listdir(REPO):
+        if name.endswith('.py'):
+            shutil.copy(os.path.join(REPO, name), workdir)
+    for name in APP_FILES:
+        shutil.copytree(os.path.join(REPO, name), os.path.join(workdir, name))
+    for name in ['uploads', 'export']:
+        os.makedirs(os.path.join(workdir, name), exist_ok=True)
+
+
+def _processIo():
+    #Bytes read / written by this process through system calls, Linux only
+    try:
+        with open('/proc/self/io') as f:
+            values = dict(x.split(': ') for x in f.read().splitlines())
+        return int(values['rchar']), int(values['wchar'])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+def _resetPeakRss():
+    #Linux resets the peak RSS (VmHWM) of the process when 5 is written to clear_refs, so every phase
+    #measures its own peak. False where that is not possible
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peakRssMb():
+    #VmHWM in MB, the peak since the last _resetPeakRss
+    try:
+        with open('/proc/self/status') as f:
+            values = dict(x.split(':', 1) for x in f.read().splitlines() if ':' in x)
+        return round(int(values['VmHWM'].split()[0]) / 1024.0, 1)
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _childRssMb():
+    #ru_maxrss of the largest finished child process (the export / upload process pools), kilobytes on Linux,
+    #bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale / 2.0 ** 20, 1)
+
+
+class Phase():
+    #with Phase(results, name, rows) as phase: ... records one phase of a case
+    def __init__(self, results, name, database, rows=0):
+        self.results = results
+        self.name = name
+        self.database = database
+        self.rows = rows
+
+    def __enter__(self):
+        self.peak = _resetPeakRss()
+        self.startRss = _peakRssMb() if self.peak else None
+        self.childRss = _childRssMb()
+        self.io = _processIo()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        seconds = time.perf_counter() - self.started
+        read, written = _processIo()
+        childRss = _childRssMb()
+        con = sqlite3.connect(self.database)
+        pageCount = con.execute('PRAGMA page_count;').fetchone()[0]
+        con.close()
+        self.results[self.name] = {'seconds': round(seconds, 4),
+                                   'rows': self.rows,
+                                   'rows_per_sec': round(self.rows / seconds, 1) if seconds > 0 else None,
+                                   #None where the peak can not be reset per phase
+                                   'start_rss_mb': self.startRss,
+                                   'peak_rss_mb': _peakRssMb() if self.peak else None,
+                                   #Only children of this phase raising the lifetime maximum are seen, None otherwise
+                                   'peak_child_rss_mb': childRss if childRss > self.childRss else None,
+                                   'process_read_bytes': read - self.io[0],
+                                   'process_written_bytes': written - self.io[1],
+                                   'db_pages': pageCount,
+                                   'failed': kind is not None}
+
+
+def _wait(client, response):
+    #Polls a queued job until it finishes, returns its final state
+    jobId = response.get_json()['job']
+    while True:
+        state = client.get('/jobs/{}'.format(jobId)).get_json()
+        if state['status'] in ('done', 'failed'):
+            if state['status'] == 'failed':
+                raise RuntimeError('Job {} failed: {}'.format(jobId, state['message']))
+            return state
+        time.sleep(0.05)
+
+
+def runCase(size, extension, merchants, schemes, workdir):
+    #Runs upload, report and export for one generated file in this process, returns the phase results
+    path = dataFile(size, extension, merchants, schemes)
+    _copyApp(workdir)
+    os.chdir(workdir)
+    sys.path.insert(0, workdir)
+    import app as application
+
+    flask = application.create_app({'SECRET_KEY': 'bench'})
+    client = flask.test_client()
+    with client.session_transaction() as session:
+        session['logged_in'] = True
+    client.get('/')
+
+    merchantFile = io.BytesIO(('MerchantName\n' + '\n'.join(merchantNames(merchants)) + '\n').encode('utf-8'))
+    client.post('/merchants/upload', data={'file': (merchantFile, 'merchants.csv')})
+    for scheme in schemeNames(schemes):
+        client.post('/cardSchemes', data={'NewCardScheme': scheme})
+
+    results = {}
+    accept = {'Accept': 'application/json'}
+    database = flask.config['DATABASE_TXN']
+    with Phase(results, 'upload', database, SIZES[size]) as phase:
+        with open(path, 'rb') as f:
+            state = _wait(client, client.post('/ExcelUpload', data={'file': (f, os.path.basename(path))}, headers=accept))
+        phase.rows = state['rows']
+    stored = sqlite3.connect(database).execute('SELECT count(*) FROM data;').fetchone()[0]
+
+    with Phase(results, 'report', database, stored):
+        assert client.get('/report').status_code == 200
+    day = (START + datetime.timedelta(days=40)).strftime('%Y-%m-%d')
+    with Phase(results, 'report_days', database, stored):
+        assert client.get('/report?from={}&to={}'.format(START.strftime('%Y-%m-%d'), day)).status_code == 200
+    with Phase(results, 'export', database, stored):
+        _wait(client, client.post('/export', data={'exportData': 'exportData'}, headers=accept))
+    return results
+
+
+def _gitCommit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark upload, report and export')
+    parser.add_argument('--sizes', default='10k', help='comma separated, any of ' + ', '.join(SIZES))
+    parser.add_argument('--formats', default='csv', help='comma separated, any of ' + ', '.join(FORMATS))
+    parser.add_argument('--merchants', type=int, default=50)
+    parser.add_argument('--schemes', type=int, default=4)
+    parser.add_argument('--out', default=None, help='results json, bench/results/<commit>.json by default')
+    parser.add_argument('--case', nargs=2, metavar=('SIZE', 'FORMAT'), help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    if options.case:
+        #Child process, prints the phase results of one case as json
+        workdir = tempfile.mkdtemp(prefix='bench_')
+        try:
+            results = runCase(options.case[0], options.case[1], options.merchants, options.schemes, workdir)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        print(json.dumps(results))
+        return
+
+    commit = _gitCommit()
+    run = {'commit': commit,
+           'created': str(datetime.datetime.now()),
+           'python': platform.python_version(),
+           'sqlite': sqlite3.sqlite_version,
+           'platform': platform.platform(),
+           'merchants': options.merchants,
+           'schemes': options.schemes,
+           'cases': []}
+    for size in options.sizes.split(','):
+        for extension in options.formats.split(','):
+            #Generate outside the measured process so the file write does not count towards it
+            dataFile(size, extension, options.merchants, options.schemes)
+            command = [sys.executable, '-m', 'bench.run', '--case', size, extension,
+                       '--merchants', str(options.merchants), '--schemes', str(options.schemes)]
+            output = subprocess.run(command, cwd=REPO, stdout=subprocess.PIPE, check=True).stdout.decode()
+            phases = json.loads(output.strip().splitlines()[-1])
+            run['cases'].append({'size': size, 'format': extension, 'phases': phases})
+            print(size, extension, ', '.join('{} {:.2f}s'.format(x, y['seconds']) for x, y in phases.items()))
+
+    out = options.out or os.path.join(REPO, 'bench', 'results', '{}.json'.format((commit or 'local')[:12]))
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump(run, f, indent=2)
+    print('Results written to', out)
+
+
+if __name__ == '__main__':
+    main()
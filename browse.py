@@ -0,0 +1,102 @@
+#Keyset pagination over stored transactions and merchants.
+#Pages continue after the last key seen instead of using OFFSET, so every page is one bounded
+#index range scan no matter how deep the user has paged. Transactions are read partition by
+#partition in month order, starting at the month of the cursor, until the page is full.
+import re
+from partitions import partitions, transactionsOf, UNDATED, MONTH
+
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+DAY = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+
+
+def encodeCursor(row):
+    #row ends with TransactionDate, TransactionId. A NULL date is written as the id alone, a date never is
+    if row[-2] is None:
+        return str(row[-1])
+    return '{}|{}'.format(row[-2], row[-1])
+
+
+def decodeCursor(cursor):
+    #(TransactionDate or None, TransactionId)
+    date, separator, rowId = cursor.rpartition('|')
+    if not rowId.isdigit():
+        raise ValueError('Bad page cursor "{}"'.format(cursor))
+    return (date if separator else None), int(rowId)
+
+
+def _where(filters):
+    where = []
+    args = []
+    if filters.get('merchant'):
+        where.append('MerchantName = ?')
+        args.append(filters['merchant'])
+    if filters.get('scheme'):
+        where.append('CardScheme = ?')
+        args.append(filters['scheme'])
+    if filters.get('upload') not in (None, ''):
+        where.append('UploadId = ?')
+        args.append(int(filters['upload']))
+    if filters.get('from'):
+        if not DAY.match(filters['from']):
+            raise ValueError('Bad date filter "{}", expected YYYY-MM-DD'.format(filters['from']))
+        where.append('TransactionDate >= ?')
+        args.append(filters['from'])
+    if filters.get('to'):
+        if not DAY.match(filters['to']):
+            raise ValueError('Bad date filter "{}", expected YYYY-MM-DD'.format(filters['to']))
+        where.append("TransactionDate < date(?, '+1 day')")
+        args.append(filters['to'])
+    return where, args
+
+
+def transactionPage(con, columns, filters, after=None, limit=PAGE_SIZE):
+    #Returns (rows, next cursor or None), rows hold columns followed by TransactionId
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+    where, args = _where(filters)
+    date, rowId = decodeCursor(after) if after else (None, None)
+    #The undated partition is read first, NULL dates and then dates that did not parse, a cursor in it
+    #continues there and then reads every month
+    undatedCursor = after and not MONTH.match(date or '')
+    if (after and not undatedCursor) or filters.get('from') or filters.get('to'):
+        #Rows without a date never match a date bound
+        start = max(x for x in (filters.get('from'), None if undatedCursor else date, '') if x is not None)
+        tables = partitions(con, start[:7] or None, filters['to'][:7] if filters.get('to') else None)
+    else:
+        #NULL dates sort first
+        tables = sorted(partitions(con), key=lambda x: x[0] != UNDATED)
+
+    rows = []
+    for month, table in tables:
+        tableWhere, tableArgs = list(where), list(args)
+        if after and (month == UNDATED or not undatedCursor):
+            if date is None:
+                tableWhere.append('(TransactionDate IS NULL AND TransactionId > ? OR TransactionDate IS NOT NULL)')
+                tableArgs.append(rowId)
+            else:
+                tableWhere.append('(TransactionDate, TransactionId) > (?, ?)')
+                tableArgs.extend([date, rowId])
+        query = 'SELECT {}, TransactionId FROM {}{} ORDER BY TransactionDate, TransactionId LIMIT ?;'.format(
+            ", ".join(columns), transactionsOf(table), ' WHERE ' + ' AND '.join(tableWhere) if tableWhere else '')
+        rows.extend(con.execute(query, tableArgs + [limit + 1 - len(rows)]).fetchall())
+        if len(rows) > limit:
+            break
+
+    nextCursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        nextCursor = encodeCursor((last[columns.index('TransactionDate')], last[-1]))
+    return rows, nextCursor
+
+
+def merchantPage(con, after=None, limit=250):
+    #Returns (names, next name cursor or None) from setup.db Merchants in name order
+    if after:
+        rows = con.execute('SELECT name FROM Merchants WHERE name > ? ORDER BY name LIMIT ?;', (after, limit + 1)).fetchall()
+    else:
+        rows = con.execute('SELECT name FROM Merchants ORDER BY name LIMIT ?;', (limit + 1,)).fetchall()
+    names = [x[0] for x in rows]
+    if len(names) > limit:
+        return names[:limit], names[limit - 1]
+    return names, None
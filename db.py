@@ -0,0 +1,102 @@
+#Connection manager for the sqlite files.
+#Every thread keeps one open connection per database file and reuses it across requests / jobs.
+#Connections are opened in WAL mode so report readers are not blocked behind an upload writer,
+#the remaining pragmas can be tuned through configure().
+import sqlite3
+import threading
+import contextlib
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+#auto_vacuum only takes effect on a new, empty file and before journal_mode = WAL writes its first page,
+#so it goes first. It lets dropped partitions shrink the file (partitions._reclaim)
+PRAGMAS = {'auto_vacuum': 'INCREMENTAL',
+           'journal_mode': 'WAL',
+           'synchronous': 'NORMAL',
+           'cache_size': -65536,
+           'mmap_size': 268435456,
+           'busy_timeout': 30000,
+           'foreign_keys': 'ON'}
+
+_local = threading.local()
+
+
+def configure(pragmas):
+    #Only affects connections opened afterwards
+    PRAGMAS.update(pragmas)
+
+
+def _open(database):
+    con = sqlite3.connect(database, timeout=PRAGMAS.get('busy_timeout', 30000) / 1000.0)
+    for name, value in PRAGMAS.items():
+        con.execute('PRAGMA {} = {};'.format(name, value))
+    return con
+
+
+def connect(database):
+    #Pooled connection for database owned by the current thread
+    pool = getattr(_local, 'connections', None)
+    if pool is None:
+        pool = _local.connections = {}
+    con = pool.get(database)
+    if con is None:
+        con = pool[database] = _open(database)
+    return con
+
+
+def release(database=None):
+    #End of a request / job, anything left uncommitted is rolled back and the connections stay open
+    for path, con in getattr(_local, 'connections', {}).items():
+        if (database is None or path == database) and con.in_transaction:
+            con.rollback()
+
+
+def closeAll():
+    for con in getattr(_local, 'connections', {}).values():
+        con.close()
+    _local.connections = {}
+
+
+class WriterBusy(Exception):
+    #A request write found data.db held by an upload / export job
+    pass
+
+
+@contextlib.contextmanager
+def writerLock(database, waiting=None, wait=True):
+    #Held by upload / export jobs for their whole run. A job keeps the sqlite write lock for a file (or an export)
+    #at a time, longer than busy_timeout, so jobs of other worker processes (gunicorn -w N) queue here instead of
+    #failing with 'database is locked'. waiting() is called when another process holds it, with wait=False
+    #WriterBusy is raised instead.
+    #Without fcntl (Windows) only the jobs of one process are serialized, by its single job thread
+    if fcntl is None:
+        yield
+        return
+    with open(database + '.lock', 'a') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            if not wait:
+                raise WriterBusy('An upload or export is running')
+            if waiting is not None:
+                waiting()
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+@contextlib.contextmanager
+def requestWriter(database):
+    #Writes made by a request. They fail at once with WriterBusy while a job holds writerLock, instead of
+    #waiting busy_timeout for it. A 'database is locked' (no fcntl, or another writer) becomes WriterBusy too
+    try:
+        with writerLock(database, wait=False):
+            yield
+    except sqlite3.OperationalError as e:
+        if 'locked' not in str(e):
+            raise
+        raise WriterBusy('An upload or export is running')
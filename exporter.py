@@ -0,0 +1,177 @@
+#Streaming export of transactions into one zip, one csv entry per merchant and month.
+#Rows come out of a single ORDER BY MerchantName, month query (sqlite spills the sort to disk),
+#are cut into batches, serialized to csv bytes across a process pool and written
+#straight into the open zip entry, so no temporary csv files are created.
+import os
+import io
+import csv
+import uuid
+import datetime
+import logging
+import collections
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
+from concurrent.futures import ProcessPoolExecutor
+from summary import summaryRemove, summaryClear
+from archive import ArchiveWriter
+from metrics import phase, timed
+from reportcache import bumpDataVersion
+from partitions import dropPartitions, deleteRows, UNDATED
+
+BATCH = 20000
+#Columns left out of exported files
+EXCLUDED = ['UploadTime', 'UploadId']
+
+
+def _csvBytes(rows):
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator='\n').writerows(rows)
+    return buffer.getvalue().encode('utf-8')
+
+
+class _InlineResult():
+    def __init__(self, value):
+        self.value = value
+
+    def result(self):
+        return self.value
+
+
+def _batches(cursor, batch=BATCH):
+    #Yields ((merchant, month), rows) runs of at most batch rows, never mixing two entries
+    key, rows = None, []
+    while True:
+        fetched = cursor.fetchmany(batch)
+        if not fetched:
+            break
+        for row in fetched:
+            rowKey = (row[0], row[1])
+            if rowKey != key or len(rows) == batch:
+                if rows:
+                    yield key, rows
+                key, rows = rowKey, []
+            rows.append(row[2:])
+    if rows:
+        yield key, rows
+
+
+def exportZip(con, zipPath, columns, where='', args=(), processes=None, compresslevel=6, zip64=True, batch=BATCH, progress=None, archiver=None):
+    #Returns (number of rows written, list of csv entry names), progress(phase, rows) is called per batch.
+    #archiver (an ArchiveWriter) receives the same batches to write the parquet copy
+    exported = [x for x in columns if x not in EXCLUDED]
+    #Rows without a usable TransactionDate go to the UNDATED entry / archive partition of their merchant
+    query = "SELECT MerchantName, coalesce(strftime('%Y-%m', TransactionDate), '{}'), {} FROM transactions{} ORDER BY MerchantName, 2;".format(
+        UNDATED, ", ".join(exported), ' WHERE ' + where if where else '')
+    header = _csvBytes([exported])
+    compression = ZIP_STORED if compresslevel == 0 else ZIP_DEFLATED
+
+    pool = ProcessPoolExecutor(processes) if processes != 0 else None
+    #Futures waiting to be written, bounded so memory does not grow with the export
+    pending = collections.deque()
+    window = 2 * (processes or 4)
+    rowCount = 0
+    entries = []
+    current = {'key': None, 'stream': None}
+
+    def write(key, future, rows):
+        if key != current['key']:
+            if current['stream'] is not None:
+                current['stream'].close()
+            arcName = "{}_{}.csv".format(key[0], key[1])
+            current['key'], current['stream'] = key, archive.open(arcName, 'w', force_zip64=zip64)
+            current['stream'].write(header)
+            entries.append(arcName)
+        #Waiting here is csv serialization the pool has not finished yet
+        with phase('export_csv', rows):
+            data = future.result()
+        with phase('export_zip', rows):
+            current['stream'].write(data)
+
+    try:
+        with ZipFile(zipPath, 'w', compression=compression, compresslevel=compresslevel or None, allowZip64=zip64) as archive:
+            cursor = con.execute(query, args)
+            for key, rows in timed(_batches(cursor, batch), 'export_query', lambda x: len(x[1])):
+                rowCount += len(rows)
+                if archiver is not None:
+                    with phase('export_archive', len(rows)):
+                        archiver.write(key, rows)
+                pending.append((key, pool.submit(_csvBytes, rows) if pool else _InlineResult(_csvBytes(rows)), len(rows)))
+                if len(pending) >= window:
+                    write(*pending.popleft())
+                if progress is not None:
+                    progress('zip', rowCount)
+            while pending:
+                write(*pending.popleft())
+            if current['stream'] is not None:
+                current['stream'].close()
+            cursor.close()
+        if archiver is not None:
+            archiver.close()
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    return rowCount, entries
+
+
+def runExport(con, progress, exportFolder, columns, fileSelected='All', processes=None, compresslevel=6, zip64=True, archiveFolder=None):
+    #Export job, writes the zip (and the parquet archive when archiveFolder is set), records it in exportHistory
+    #and purges the exported rows
+    exportTimestamp = datetime.datetime.now()
+    zipExportFile = "export_" + str(exportTimestamp) + ".zip"
+
+    #The export query and the purge run in one write transaction, an upload committed in between would
+    #otherwise be purged without being exported. Uploads wait for the export (up to busy_timeout), reports do not
+    con.execute('BEGIN IMMEDIATE;')
+
+    #Get Max exportID if exist
+    exportId = con.execute('Select max(exportId) from exportHistory').fetchone()[0]
+    exportId = 0 if exportId == None else exportId + 1
+    archiveName = '{}-{}'.format(exportTimestamp.strftime('%Y%m%d%H%M%S'), uuid.uuid4().hex)
+    archiver = ArchiveWriter(archiveFolder, [x for x in columns if x not in EXCLUDED], archiveName) if archiveFolder else None
+
+    try:
+        #Reject csvs of the purged uploads, removed once the purge is committed
+        if fileSelected == "All":
+            rejectFiles = [x[0] for x in con.execute('SELECT rejectFile FROM UploadHistory WHERE rejectFile IS NOT NULL;')]
+        else:
+            rejectFiles = [x[0] for x in con.execute('SELECT rejectFile FROM UploadHistory WHERE rejectFile IS NOT NULL AND UploadId = ?;', (fileSelected,))]
+
+        #Stream merchant / month csv entries straight into the zip
+        if fileSelected == "All":
+            RowLen, files = exportZip(con, exportFolder + zipExportFile, columns, processes=processes, compresslevel=compresslevel, zip64=zip64, progress=progress, archiver=archiver)
+        else:
+            RowLen, files = exportZip(con, exportFolder + zipExportFile, columns, 'UploadId = ?', (fileSelected,), processes=processes, compresslevel=compresslevel, zip64=zip64, progress=progress, archiver=archiver)
+        logging.info("Zip {} created with {} files".format(zipExportFile, len(files)))
+
+        #Add line within export history
+
+        progress('delete', RowLen)
+        con.execute("""INSERT INTO exportHistory (exportDate, success, len, filename, exportId) VALUES (?, ?, ?, ?, ?);""", (str(exportTimestamp), 'True', RowLen, zipExportFile, exportId))
+        logging.info("Export record generated")
+        with phase('export_delete', RowLen):
+            if fileSelected == "All":
+                summaryClear(con, commit=False)
+                dropPartitions(con)
+                logging.info("All transaction data in local storage deleted")
+                con.execute("""DELETE FROM UploadHistory;""")
+                logging.info("All data in UploadHistory deleted")
+            else:
+                summaryRemove(con, 'UploadId = ?', (fileSelected,), commit=False)
+                deleteRows(con, 'UploadId = ?', (fileSelected,))
+                logging.info("All transaction data in local storage deleted from Upload fileId {}".format(fileSelected))
+                con.execute("""DELETE FROM UploadHistory where UploadId = ?;""", (fileSelected,))
+                logging.info("All data in UploadHistory deleted from upload fileID {}".format(fileSelected))
+            bumpDataVersion(con)
+            con.commit()
+    except:
+        con.rollback()
+        if os.path.exists(exportFolder + zipExportFile):
+            os.remove(exportFolder + zipExportFile)
+        if archiver is not None:
+            archiver.abort()
+        raise
+
+    for path in rejectFiles:
+        if os.path.exists(path):
+            os.remove(path)
+    return 'File exported successfully, {} rows in {}'.format(RowLen, zipExportFile)
@@ -0,0 +1,409 @@
+#Chunked ingestion of transaction files into data.db.
+#Each chunk is filtered, normalized and inserted before the next one is read,
+#so peak memory depends on the chunk size and not on the file size.
+#Batch uploads parse their files across a process pool and store them through the job thread,
+#the only writer, one file per transaction. Workers spill every parsed chunk to disk, so the writer
+#also holds a single chunk at a time.
+import os
+import time
+import uuid
+import shutil
+import zipfile
+import json
+import datetime
+import logging
+import collections
+from concurrent.futures import ProcessPoolExecutor
+from werkzeug.utils import secure_filename
+from readers import readChunks, CHUNKSIZE
+from summary import summaryAdd
+from normalize import parseTransactionDate, formatDates, parseAmounts, parseCurrencyCodes
+from schema import LOOKUPS, storedColumns, lookupIds, rowHashes
+from partitions import partitionTable, monthsOf, allocateIds
+from search import indexRows
+from metrics import phase, timed
+from matching import EXACT
+from validate import validateChunk, RejectWriter, RULES, CURRENCY_COLUMNS
+from reportcache import bumpDataVersion
+
+
+class IngestError(Exception):
+    pass
+
+
+def _records(df):
+    #sqlite3 only binds python types, NaN/NaT become NULL
+    df = df.astype(object).where(df.notnull(), None)
+    return df.itertuples(index=False, name=None)
+
+
+def _allowed(values, allowed):
+    #Set lookups on the distinct values only, the mask itself is one vectorized isin
+    return values.isin([x for x in values.unique() if x in allowed])
+
+
+def insertTransactions(con, df, columns):
+    #Merchant and card scheme names are stored as ids of their lookup tables, rows go to the partition of their month.
+    #Rows whose natural key is already stored (or repeated within df) are skipped by the RowHash index of the
+    #partition, the key includes TransactionDate so a duplicate always lands in the same one.
+    #Inserted rows are added to the search index. Returns the number of rows actually inserted
+    df = df[columns].copy()
+    df['RowHash'] = rowHashes(df)
+    for col in LOOKUPS:
+        df[col] = df[col].map(lookupIds(con, col, df[col].dropna().unique().tolist()))
+    first = allocateIds(con, df.shape[0])
+    df.insert(0, 'TransactionId', range(first, first + df.shape[0]))
+    inserted = 0
+    for month, part in df.groupby(monthsOf(df['TransactionDate']).values, sort=False):
+        table = partitionTable(con, month)
+        query = 'INSERT INTO {} (TransactionId, {}, RowHash) VALUES ({}) ON CONFLICT(RowHash) DO NOTHING;'.format(
+            table, ", ".join(storedColumns(columns)), ", ".join(['?'] * (len(columns) + 2)))
+        inserted += con.executemany(query, _records(part)).rowcount
+        #The ids of this call, skipped duplicates were never stored
+        indexRows(con, table, 'TransactionId >= ? AND TransactionId < ?', (first, first + df.shape[0]))
+    return inserted
+
+
+def _normalize(df, extension, columns, timestamp, UploadId):
+    #add empty columns
+    for col in columns:
+        if col not in df.columns:
+            df[col] = None
+
+    df['UploadTime'] = str(timestamp)
+
+    for col in CURRENCY_COLUMNS:
+        df[col] = parseCurrencyCodes(df[col])
+
+    #Fix Datatime, rows with and without seconds can be mixed within a file
+    with phase('upload_parse_dates', df.shape[0]):
+        df['TransactionDate'] = formatDates(parseTransactionDate(df['TransactionDate'], extension))
+
+    #Make sure Sale Amount is proper float, as it might come with semicolons from excel file
+    with phase('upload_parse_amounts', df.shape[0]):
+        df['SaleAmount'] = parseAmounts(df['SaleAmount'])
+
+    df['UploadId'] = UploadId
+    return df[columns]
+
+
+COUNTS = ['rows_read', 'rows_inserted', 'rows_skipped', 'rows_rejected', 'chunks']
+
+
+def _newStats():
+    stats = {x: 0 for x in COUNTS}
+    stats.update({'merchants_matched': {}, 'rejects': {x: 0 for x in RULES}, 'reject_file': None})
+    return stats
+
+
+def _addStats(totals, stats):
+    for key in COUNTS:
+        totals[key] += stats[key]
+    for rule, count in stats['rejects'].items():
+        totals['rejects'][rule] += count
+    totals['merchants_matched'].update(stats['merchants_matched'])
+
+
+def _rejectPath(folder, filename):
+    #Reject csv of one upload, prefixed like the saved uploads so names never collide
+    if folder is None:
+        return None
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, '{}_{}_rejects.csv'.format(uuid.uuid4().hex, filename.rsplit('.', 1)[0]))
+
+
+def _matchMerchants(names, Merchants, resolved, stats):
+    #Allowlisted name per row (None when unmatched). Each distinct name is resolved once per file,
+    #resolved carries the results from chunk to chunk, names not matched exactly go to stats
+    new = [x for x in names.dropna().unique() if x not in resolved]
+    for name, (match, kind) in Merchants.resolve(new).items():
+        resolved[name] = match
+        if match is not None and kind != EXACT:
+            stats['merchants_matched'][name] = (match, kind)
+    return names.map(resolved)
+
+
+def parseChunks(path, extension, columns, Merchants, CardSchemes, UploadId, timestamp, chunksize=CHUNKSIZE, stats=None, rejectPath=None):
+    #Yields the filtered, normalized and validated chunks of a file, empty ones included so progress keeps moving.
+    #Merchants is a MerchantMatcher, rows keep the allowlisted spelling of their merchant.
+    #Rows failing validation (validate.py) are left out and, with rejectPath, written there as read.
+    #stats gets rows_read, chunks, merchants_matched, rows_rejected, rejects (per rule) and reject_file
+    stats = stats if stats is not None else _newStats()
+    rejects = RejectWriter(rejectPath) if rejectPath is not None else None
+    resolved = {}
+    for df in timed(readChunks(path, extension, chunksize, columns), 'upload_read'):
+        if stats['chunks'] == 0:
+            if ('MerchantName' not in df.columns) or ('CardScheme' not in df.columns):
+                raise IngestError('Could not find MerchantName or CardScheme columns in the data')
+
+        stats['chunks'] += 1
+        stats['rows_read'] += df.shape[0]
+
+        #apply filtering
+        with phase('upload_filter', df.shape[0]):
+            names = _matchMerchants(df['MerchantName'], Merchants, resolved, stats)
+            keep = names.notnull() & _allowed(df['CardScheme'], CardSchemes)
+            raw = df[keep]
+        if raw.shape[0] == 0:
+            yield raw
+            continue
+
+        df = _normalize(raw.assign(MerchantName=names[keep]), extension, columns, timestamp, UploadId)
+        with phase('upload_validate', df.shape[0]):
+            good, reasons, counts = validateChunk(raw, df)
+        if not reasons.empty:
+            stats['rows_rejected'] += reasons.shape[0]
+            for rule, count in counts.items():
+                stats['rejects'][rule] += count
+            if rejects is not None:
+                rejects.write(raw, reasons)
+                stats['reject_file'] = rejectPath
+            df = df[good]
+        yield df
+
+
+def ingestFrames(con, frames, columns, UploadId, stats, progress=None):
+    #Stores the frames of one upload in one transaction, either every chunk is stored or none
+    #progress(phase, rows) is called after every chunk
+    started = time.time()
+    try:
+        for df in frames:
+            if df.shape[0] > 0:
+                with phase('upload_insert', df.shape[0]):
+                    inserted = insertTransactions(con, df, columns)
+                stats['rows_inserted'] += inserted
+                stats['rows_skipped'] += df.shape[0] - inserted
+            if progress is not None:
+                progress('ingest', stats['rows_read'])
+
+        #Rollup of the rows this upload inserted, duplicates that were skipped are not counted twice
+        with phase('upload_summary', stats['rows_inserted']):
+            summaryAdd(con, 'UploadId = ?', (UploadId,), commit=False)
+        bumpDataVersion(con)
+        if progress is not None:
+            progress('commit', stats['rows_read'])
+        with phase('upload_commit', stats['rows_inserted']):
+            con.commit()
+    except:
+        con.rollback()
+        raise
+
+    stats['seconds'] = time.time() - started
+    stats['rows_per_sec'] = stats['rows_read'] / stats['seconds'] if stats['seconds'] > 0 else 0.0
+    logging.info("Ingested {} of {} rows ({} duplicates skipped, {} rejected) in {} chunks, {:.2f}s ({:.0f} rows/sec)".format(stats['rows_inserted'], stats['rows_read'], stats['rows_skipped'], stats['rows_rejected'], stats['chunks'], stats['seconds'], stats['rows_per_sec']))
+    return stats
+
+
+def ingestFile(con, path, extension, columns, Merchants, CardSchemes, UploadId, timestamp, chunksize=CHUNKSIZE, progress=None, stats=None, rejectPath=None):
+    #Reads and stores a file chunk by chunk in one transaction
+    stats = stats if stats is not None else _newStats()
+    return ingestFrames(con, parseChunks(path, extension, columns, Merchants, CardSchemes, UploadId, timestamp, chunksize, stats, rejectPath), columns, UploadId, stats, progress)
+
+
+def allocateUpload(con, filename, timestamp):
+    #Reserves the next UploadId together with its UploadHistory row in a single statement, sqlite runs it
+    #under the write lock so concurrent uploads never get the same id. The row stays 'Pending' until recordUpload
+    cursor = con.execute("""INSERT INTO UploadHistory (uploadtime, filename, success, len, UploadId, skipped)
+                            SELECT ?, ?, 'Pending', 0, coalesce(max(UploadId) + 1, 0), 0 FROM UploadHistory;""", (str(timestamp), filename))
+    UploadId = con.execute('SELECT UploadId FROM UploadHistory WHERE rowid = ?;', (cursor.lastrowid,)).fetchone()[0]
+    con.commit()
+    return UploadId
+
+
+def recordUpload(con, UploadId, filename, stats=None, error=None):
+    #Stores the outcome of an upload on the row allocateUpload reserved, rejected rows are recorded
+    #for failed uploads too so their reject file can still be downloaded
+    if stats is not None:
+        con.execute('UPDATE UploadHistory SET rejected = ?, rejectCounts = ?, rejectFile = ? WHERE UploadId = ?;',
+                    (stats['rows_rejected'], json.dumps(stats['rejects']), stats['reject_file'], UploadId))
+    if error is None:
+        con.execute("UPDATE UploadHistory SET success = 'True', len = ?, skipped = ? WHERE UploadId = ?;", (stats['rows_inserted'], stats['rows_skipped'], UploadId))
+        logging.info("Successfully uploaded file ({}) contents to a database".format(filename))
+        for name, (match, kind) in sorted(stats['merchants_matched'].items()):
+            logging.info('Merchant name "{}" in file ({}) matched to "{}" ({})'.format(name, filename, match, kind))
+    else:
+        con.execute("UPDATE UploadHistory SET success = 'False', len = 0, skipped = 0 WHERE UploadId = ?;", (UploadId,))
+        logging.info('Failed to upload data from file ({}) to a database: {}'.format(filename, error))
+    con.commit()
+
+
+def _matchedNote(matched, shown=5):
+    #Tail of the job message naming the merchant names that were not allowlisted as written
+    if not matched:
+        return ''
+    names = sorted(matched.items())
+    note = '. {} merchant names matched fuzzily: {}'.format(len(names), ', '.join('"{}" as "{}"'.format(x, y[0]) for x, y in names[:shown]))
+    return note + (', ...' if len(names) > shown else '')
+
+
+def _rejectedNote(stats):
+    #Tail of the job message with the rows that failed validation
+    if stats['rows_rejected'] == 0:
+        return ''
+    rules = ', '.join('{} {}'.format(y, x) for x, y in stats['rejects'].items() if y > 0)
+    return '. {} rows rejected ({})'.format(stats['rows_rejected'], rules)
+
+
+def _checkStored(stats):
+    if stats['rows_inserted'] == 0:
+        if stats['rows_skipped'] > 0:
+            raise IngestError('All {} rows are already stored, nothing uploaded'.format(stats['rows_skipped']))
+        if stats['rows_rejected'] > 0:
+            raise IngestError('All {} rows failed validation, nothing uploaded'.format(stats['rows_rejected']) + _rejectedNote(stats))
+        raise IngestError('No data to upload after applying filtering')
+
+
+def runUpload(con, progress, path, filename, extension, columns, Merchants, CardSchemes, rejectFolder=None):
+    #Upload job, allocates the UploadId, ingests the saved file and records the outcome in UploadHistory.
+    #Rows failing validation are written to a reject csv in rejectFolder
+    try:
+        timestamp = datetime.datetime.now()
+        UploadId = allocateUpload(con, filename, timestamp)
+        stats = _newStats()
+        try:
+            ingestFile(con, path, extension, columns, Merchants, CardSchemes, UploadId, timestamp, progress=progress, stats=stats, rejectPath=_rejectPath(rejectFolder, filename))
+            _checkStored(stats)
+        except Exception as e:
+            recordUpload(con, UploadId, filename, stats, error=e)
+            raise
+
+        recordUpload(con, UploadId, filename, stats)
+        return 'Success. {} rows uploaded, {} duplicates skipped ({:.0f} rows/sec)'.format(stats['rows_inserted'], stats['rows_skipped'], stats['rows_per_sec']) + _rejectedNote(stats) + _matchedNote(stats['merchants_matched'])
+    finally:
+        os.remove(path)
+
+
+#Batch upload
+def _spillDir(path):
+    return path + '.chunks'
+
+
+def _parseFile(path, extension, columns, Merchants, CardSchemes, UploadId, timestamp, rejectPath=None, chunksize=CHUNKSIZE):
+    #Process pool task, pickles the filtered chunks to _spillDir(path) one by one so only the writer touches
+    #data.db and nothing larger than a chunk is held or sent back. Returns (number of chunks, stats).
+    #Rejected rows are written by the worker itself, each file has its own reject csv
+    stats = _newStats()
+    directory = _spillDir(path)
+    os.makedirs(directory, exist_ok=True)
+    count = 0
+    for df in parseChunks(path, extension, columns, Merchants, CardSchemes, UploadId, timestamp, chunksize, stats, rejectPath):
+        if df.shape[0] > 0:
+            df.to_pickle(os.path.join(directory, '{}.pkl'.format(count)))
+            count += 1
+    return count, stats
+
+
+def _spilledChunks(path, count):
+    #Chunks written by _parseFile, each removed once read
+    import pandas as pd
+    directory = _spillDir(path)
+    for number in range(count):
+        chunk = os.path.join(directory, '{}.pkl'.format(number))
+        df = pd.read_pickle(chunk)
+        os.remove(chunk)
+        yield df
+
+
+def _expandZip(path, extensions):
+    #Saves the supported files of a zip next to it as (path, filename, extension), folders inside are ignored
+    files, ignored = [], []
+    with zipfile.ZipFile(path) as archive:
+        for info in archive.infolist():
+            if info.is_dir() or info.filename.startswith('__MACOSX/'):
+                continue
+            filename = secure_filename(os.path.basename(info.filename)).strip().replace(" ", "_")
+            extension = filename.rsplit(".", 1)[1].lower() if '.' in filename else ''
+            if extension not in extensions:
+                ignored.append(info.filename)
+                continue
+            target = os.path.join(os.path.dirname(path), uuid.uuid4().hex + "_" + filename)
+            with archive.open(info) as source, open(target, 'wb') as f:
+                while True:
+                    data = source.read(1 << 20)
+                    if not data:
+                        break
+                    f.write(data)
+            files.append((target, filename, extension))
+    return files, ignored
+
+
+def runBatchUpload(con, progress, files, columns, Merchants, CardSchemes, extensions, processes=None, rejectFolder=None):
+    #Batch upload job, files are (path, filename, extension) as saved by the request, zip archives are
+    #expanded first. Every file gets its own UploadId, UploadHistory row and transaction, a failing file
+    #does not stop the others. Files are stored in the order they were sent, so of duplicates across
+    #files the first one wins.
+    started = time.time()
+    paths = [x[0] for x in files]
+    pool = None
+    try:
+        expanded, ignored = [], []
+        for path, filename, extension in files:
+            if extension == 'zip':
+                entries, skipped = _expandZip(path, extensions)
+                paths.extend(x[0] for x in entries)
+                expanded.extend(entries)
+                ignored.extend(skipped)
+            else:
+                expanded.append((path, filename, extension))
+        if not expanded:
+            raise IngestError('No csv, xlsx or ods files to upload')
+
+        timestamp = datetime.datetime.now()
+        uploads = [(allocateUpload(con, filename, timestamp), path, filename, extension) for path, filename, extension in expanded]
+
+        #A single file, or processes = 0, is read and stored chunk by chunk in the job thread like a single upload
+        pool = ProcessPoolExecutor(processes) if processes != 0 and len(uploads) > 1 else None
+        #Parsed files waiting for the writer, bounded so the spilled chunks on disk do not grow with the batch
+        pending = collections.deque()
+        window = 2 * (processes or 4)
+        totals = _newStats()
+        failed = []
+
+        def store(UploadId, path, filename, extension, future):
+            stats = None
+            try:
+                if future is None:
+                    stats = _newStats()
+                    ingestFile(con, path, extension, columns, Merchants, CardSchemes, UploadId, timestamp, stats=stats, rejectPath=_rejectPath(rejectFolder, filename),
+                               progress=lambda phase, rows: progress(phase, totals['rows_read'] + rows))
+                else:
+                    count, stats = future.result()
+                    ingestFrames(con, _spilledChunks(path, count), columns, UploadId, stats)
+                _checkStored(stats)
+            except Exception as e:
+                recordUpload(con, UploadId, filename, stats, error=e)
+                failed.append('{} ({})'.format(filename, str(e) or e.__class__.__name__))
+                return
+            recordUpload(con, UploadId, filename, stats)
+            _addStats(totals, stats)
+            progress('ingest', totals['rows_read'])
+
+        for UploadId, path, filename, extension in uploads:
+            if pool is None:
+                store(UploadId, path, filename, extension, None)
+                continue
+            args = (path, extension, columns, Merchants, CardSchemes, UploadId, timestamp, _rejectPath(rejectFolder, filename))
+            pending.append((UploadId, path, filename, extension, pool.submit(_parseFile, *args)))
+            if len(pending) >= window:
+                store(*pending.popleft())
+        while pending:
+            store(*pending.popleft())
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+            shutil.rmtree(_spillDir(path), ignore_errors=True)
+
+    seconds = time.time() - started
+    message = 'Uploaded {} of {} files. {} rows uploaded, {} duplicates skipped ({:.0f} rows/sec)'.format(
+        len(uploads) - len(failed), len(uploads), totals['rows_inserted'], totals['rows_skipped'], totals['rows_read'] / seconds if seconds > 0 else 0.0)
+    message += _rejectedNote(totals) + _matchedNote(totals['merchants_matched'])
+    if failed:
+        message += '. Failed: ' + ', '.join(failed)
+    if ignored:
+        message += '. Ignored: ' + ', '.join(ignored)
+    if len(failed) == len(uploads):
+        raise IngestError(message)
+    return message
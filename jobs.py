@@ -0,0 +1,127 @@
+#Background jobs for uploads and exports.
+#Work runs on a small thread pool outside the request, job state is kept in its own
+#sqlite file (jobs.db) so progress can be written while data.db is locked by the job itself,
+#and read back by any worker process serving /jobs/<id>.
+#Jobs on the same database run one at a time across worker processes too, see db.writerLock.
+import time
+import datetime
+import logging
+import threading
+import cProfile
+from concurrent.futures import ThreadPoolExecutor
+import db
+
+JOB_COLUMNS = ['JobId', 'kind', 'filename', 'status', 'phase', 'rows', 'rowsPerSec', 'message', 'created', 'updated']
+
+_executor = None
+_executorLock = threading.Lock()
+
+
+def _connect(database):
+    con = db.connect(database)
+    con.execute('CREATE TABLE IF NOT EXISTS jobs(JobId integer PRIMARY KEY, kind text, filename text, status text, phase text, rows integer, rowsPerSec real, message text, created timestamp, updated timestamp);')
+    return con
+
+
+def _getExecutor(workers):
+    global _executor
+    with _executorLock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=workers)
+        return _executor
+
+
+class Progress():
+    #Passed to job tasks, called as progress(phase, rows) while they run
+    def __init__(self, database, jobId, interval=0.5):
+        self.database = database
+        self.jobId = jobId
+        self.interval = interval
+        self.started = time.time()
+        self.lastWrite = 0
+        self.phase = None
+        self.rows = 0
+
+    def __call__(self, phase, rows=None):
+        #Written straight away on a new phase, otherwise at most once per interval
+        if rows is not None:
+            self.rows = rows
+        now = time.time()
+        if phase == self.phase and now - self.lastWrite < self.interval:
+            return
+        self.phase = phase
+        self.lastWrite = now
+        elapsed = now - self.started
+        self.update(phase=phase, rows=self.rows, rowsPerSec=self.rows / elapsed if elapsed > 0 else 0.0)
+
+    def update(self, **values):
+        values['updated'] = str(datetime.datetime.now())
+        con = _connect(self.database)
+        try:
+            con.execute('UPDATE jobs SET {} WHERE JobId = ?;'.format(", ".join("{} = ?".format(x) for x in values)), list(values.values()) + [self.jobId])
+            con.commit()
+        finally:
+            db.release(self.database)
+
+
+def _run(database, target, jobId, task, args, profile=None):
+    progress = Progress(database, jobId)
+    progress.update(status='running', phase='starting')
+    con = db.connect(target)
+    profiler = cProfile.Profile() if profile else None
+    if profiler is not None:
+        try:
+            profiler.enable()
+        except ValueError:
+            #Newer pythons allow one active profiler per process, e.g. the request that queued this job
+            logging.info("Job {} not profiled, another profiler is active".format(jobId))
+            profiler = None
+    try:
+        with db.writerLock(target, lambda: progress('waiting')):
+            message = task(con, progress, *args)
+        progress('done')
+        progress.update(status='done', message=message)
+        logging.info("Job {} done: {}".format(jobId, message))
+    except Exception as e:
+        logging.exception("Job {} failed".format(jobId))
+        progress('failed')
+        progress.update(status='failed', message=str(e) or e.__class__.__name__)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile)
+            logging.info("Job {} profile written to {}".format(jobId, profile))
+        db.release(target)
+
+
+def submitJob(database, target, kind, filename, task, args=(), workers=1, profile=None):
+    #Queues task(con, progress, *args) against the target database and returns the job id at once.
+    #task returns the message stored with the finished job, profile is a path to dump a cProfile of the job to.
+    con = _connect(database)
+    try:
+        timestamp = str(datetime.datetime.now())
+        jobId = con.execute('INSERT INTO jobs (kind, filename, status, phase, rows, rowsPerSec, created, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?);',
+                            (kind, filename, 'queued', 'queued', 0, 0.0, timestamp, timestamp)).lastrowid
+        con.commit()
+    finally:
+        db.release(database)
+    _getExecutor(workers).submit(_run, database, target, jobId, task, args, profile)
+    return jobId
+
+
+def getJob(database, jobId):
+    con = _connect(database)
+    try:
+        row = con.execute('SELECT {} FROM jobs WHERE JobId = ?;'.format(", ".join(JOB_COLUMNS)), (jobId,)).fetchone()
+    finally:
+        db.release(database)
+    return dict(zip(JOB_COLUMNS, row)) if row else None
+
+
+def recentJobs(database, kind, limit=10):
+    con = _connect(database)
+    try:
+        rows = con.execute('SELECT {} FROM jobs WHERE kind = ? ORDER BY JobId DESC LIMIT ?;'.format(", ".join(JOB_COLUMNS)), (kind, limit)).fetchall()
+    finally:
+        db.release(database)
+    return [dict(zip(JOB_COLUMNS, x)) for x in rows]
@@ -0,0 +1,125 @@
+#Matching of uploaded MerchantName values against the Merchants allowlist.
+#Names are compared exactly first, then by a normalized key (case, accents, punctuation and whitespace
+#removed) in a hash map, and last by trigram similarity of the keys through an inverted index. Only the
+#distinct names of a file are resolved, every row then takes the result of its name with one Series.map.
+import re
+import math
+import collections
+import unicodedata
+
+#Minimal Dice similarity of the key trigrams for a fuzzy match
+FUZZY_THRESHOLD = 0.8
+NON_ALNUM = re.compile(r'[\W_]+')
+DIGITS = re.compile(r'\d+')
+
+EXACT = 'exact'
+NORMALIZED = 'normalized'
+FUZZY = 'fuzzy'
+
+
+def normalizedKey(name):
+    #'  Café-Shop, A. ' -> 'cafe shop a'
+    text = unicodedata.normalize('NFKD', str(name))
+    text = ''.join(x for x in text if not unicodedata.combining(x)).casefold()
+    return NON_ALNUM.sub(' ', text).strip()
+
+
+def trigrams(key):
+    padded = ' {} '.format(key)
+    return {padded[x:x + 3] for x in range(len(padded) - 2)}
+
+
+class MerchantMatcher():
+    def __init__(self, names, threshold=FUZZY_THRESHOLD):
+        self.names = frozenset(names)
+        self.threshold = threshold
+        #Key -> name, None when several names share the key and it can not choose between them
+        self.keys = {}
+        for name in self.names:
+            key = normalizedKey(name)
+            self.keys[key] = name if key not in self.keys else None
+        self._index = None
+
+    def __getstate__(self):
+        #Sent to upload worker processes without the trigram index, it is rebuilt there when needed
+        state = dict(self.__dict__)
+        state['_index'] = None
+        return state
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def _trigramIndex(self):
+        #(keys, trigram -> positions in keys, trigram count per key), built on the first fuzzy lookup
+        if self._index is None:
+            keys = [x for x, name in self.keys.items() if name is not None and x]
+            postings = {}
+            sizes = []
+            for position, key in enumerate(keys):
+                grams = trigrams(key)
+                sizes.append(len(grams))
+                for gram in grams:
+                    postings.setdefault(gram, []).append(position)
+            self._index = (keys, postings, sizes)
+        return self._index
+
+    def _fuzzy(self, key):
+        #Name of the most similar key, None below the threshold, on a tie or when the numbers differ
+        #(store 1234 is not store 1235).
+        #A key reaching the threshold shares at least needed of the query trigrams, so it is in the postings
+        #of one of the len - needed + 1 rarest ones. Those give the candidates, the postings of the next ones
+        #are counted while they are shorter than the candidate list, and candidates that can no longer reach
+        #needed are dropped. Common trigrams ('ltd', 'the') are never read, they are looked up in the padded
+        #candidate key instead
+        keys, postings, sizes = self._trigramIndex()
+        grams = trigrams(key)
+        needed = math.ceil(self.threshold * len(grams) / (2 - self.threshold))
+        ordered = sorted(grams, key=lambda x: len(postings.get(x, ())))
+        read = len(grams) - needed + 1
+        hits = collections.Counter()
+        for gram in ordered[:read]:
+            hits.update(postings.get(gram, ()))
+        for gram in ordered[read:]:
+            posting = postings.get(gram, ())
+            if len(posting) > len(hits):
+                break
+            for position in posting:
+                if position in hits:
+                    hits[position] += 1
+            read += 1
+        unread = ordered[read:]
+
+        scores = {}
+        for position, count in hits.items():
+            if count + len(unread) < needed:
+                continue
+            padded = ' {} '.format(keys[position])
+            shared = count + sum(1 for x in unread if x in padded)
+            score = 2.0 * shared / (len(grams) + sizes[position])
+            if score >= self.threshold:
+                scores[position] = score
+        if not scores:
+            return None
+        ranked = sorted(scores, key=scores.get, reverse=True)
+        if len(ranked) > 1 and scores[ranked[1]] == scores[ranked[0]]:
+            return None
+        match = keys[ranked[0]]
+        if DIGITS.findall(match) != DIGITS.findall(key):
+            return None
+        return self.keys[match]
+
+    def resolve(self, names):
+        #Distinct names -> {name: (allowlisted name or None, EXACT / NORMALIZED / FUZZY or None)}
+        resolved = {}
+        for name in names:
+            if name in self.names:
+                resolved[name] = (name, EXACT)
+                continue
+            key = normalizedKey(name)
+            match = self.keys.get(key)
+            if match is not None:
+                resolved[name] = (match, NORMALIZED)
+                continue
+            match = self._fuzzy(key) if key and key not in self.keys and self.threshold <= 1 else None
+            resolved[name] = (match, FUZZY if match is not None else None)
+        return resolved
@@ -0,0 +1,123 @@
+#Opt-in timings for the upload, report and export hot paths.
+#Code marks a phase with `with phase('upload_read') as p: ...; p.rows = n`, every run adds its duration,
+#row count and RSS change to per phase totals kept in this process. renderPrometheus() returns them in
+#the Prometheus text format for /metrics. Disabled (the default) a phase costs one attribute lookup.
+import os
+import time
+import resource
+import threading
+
+PREFIX = 'transactions'
+
+_enabled = [False]
+_lock = threading.Lock()
+#phase name -> {'count', 'seconds', 'rows', 'memory', 'lastMemory'}
+_totals = {}
+
+
+def enable(on=True):
+    _enabled[0] = bool(on)
+
+
+def enabled():
+    return _enabled[0]
+
+
+def _rss():
+    #Current resident set size in bytes, peak RSS where /proc is not available
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class _Phase():
+    def __init__(self, name, rows):
+        self.name = name
+        self.rows = rows
+
+    def __enter__(self):
+        self.memory = _rss()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        record(self.name, time.perf_counter() - self.started, self.rows, _rss() - self.memory)
+
+
+class _NoPhase():
+    rows = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        pass
+
+
+_noPhase = _NoPhase()
+
+
+def phase(name, rows=None):
+    #Context manager timing one run of a phase, rows may also be set on it before the block ends
+    return _Phase(name, rows) if _enabled[0] else _noPhase
+
+
+def timed(iterable, name, rows=len):
+    #Yields from iterable, timing every next() as one run of name with rows(item) rows
+    iterator = iter(iterable)
+    while True:
+        with phase(name) as p:
+            try:
+                item = next(iterator)
+            except StopIteration:
+                p.rows = 0
+                return
+            p.rows = rows(item) if rows is not None else None
+        yield item
+
+
+def record(name, seconds, rows=None, memory=0):
+    with _lock:
+        totals = _totals.setdefault(name, {'count': 0, 'seconds': 0.0, 'rows': 0, 'memory': 0, 'lastMemory': 0})
+        totals['count'] += 1
+        totals['seconds'] += seconds
+        totals['rows'] += rows or 0
+        totals['memory'] += memory
+        totals['lastMemory'] = memory
+
+
+def snapshot():
+    with _lock:
+        return {x: dict(y) for x, y in _totals.items()}
+
+
+def reset():
+    with _lock:
+        _totals.clear()
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def renderPrometheus():
+    totals = snapshot()
+    series = [('phase_seconds', 'summary', 'Time spent in an instrumented phase', None),
+              ('phase_rows_total', 'counter', 'Rows handled by an instrumented phase', 'rows'),
+              ('phase_memory_delta_bytes_sum', 'gauge', 'Sum of resident memory changes over runs of a phase, can be negative', 'memory'),
+              ('phase_last_memory_delta_bytes', 'gauge', 'Resident memory change over the last run of a phase', 'lastMemory')]
+    lines = []
+    for metric, kind, description, key in series:
+        name = '{}_{}'.format(PREFIX, metric)
+        lines.append('# HELP {} {}'.format(name, description))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        for phaseName in sorted(totals):
+            label = '{{phase="{}"}}'.format(_escape(phaseName))
+            if key is None:
+                lines.append('{}_sum{} {!r}'.format(name, label, totals[phaseName]['seconds']))
+                lines.append('{}_count{} {}'.format(name, label, totals[phaseName]['count']))
+            else:
+                lines.append('{}{} {}'.format(name, label, totals[phaseName][key]))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,59 @@
+#Vectorized normalization of uploaded columns.
+#Every parser works on a whole column with one pandas call per format,
+#rows already parsed are not retried when falling back to the next format.
+import numbers
+import pandas as pd
+
+#Accepted TransactionDate formats per source file type, tried in order.
+#The ISO variants cover real date cells, which the xlsx/ods readers hand back as datetimes / ISO strings.
+DATE_FORMATS = {'csv': ["%d/%m/%Y %H:%M:%S", "%d/%m/%Y %H:%M"],
+                'ods': ["%Y/%m/%dT%H:%M:%S", "%Y/%m/%dT%H:%M", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%d"],
+                'xlsx': ["%Y/%m/%d %H:%M:%S", "%Y/%m/%d %H:%M", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"]}
+
+STORAGE_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def parseDates(values, formats):
+    #Returns datetime64 values, NaT where no format matched
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+
+    result = pd.Series(pd.NaT, index=values.index, dtype='datetime64[ns]')
+    present = values.notnull()
+    text = values[present].astype(str).str.strip()
+    for fmt in formats:
+        todo = result[present].isnull()
+        if not todo.any():
+            break
+        result.loc[todo[todo].index] = pd.to_datetime(text[todo], format=fmt, errors='coerce')
+    return result
+
+
+def parseTransactionDate(values, source):
+    #NaT where no format of source matched, those rows are rejected by validation
+    return parseDates(values, DATE_FORMATS[source])
+
+
+def formatDates(values):
+    #Text stored in data.db, sortable and understood by sqlite date functions
+    return values.dt.strftime(STORAGE_DATE_FORMAT)
+
+
+def parseAmounts(values):
+    #Decimal comma amounts, eg "12,50", are converted in bulk, NaN where the value is not a number
+    if pd.api.types.is_numeric_dtype(values):
+        return values.astype(float)
+    text = values.astype(str).str.strip().str.replace(",", ".", regex=False)
+    return pd.to_numeric(text.where(values.notnull()), errors='coerce').astype(float)
+
+
+def parseCurrencyCodes(values):
+    #Numeric ISO 4217 codes of spreadsheet number cells (840.0, 36) become 3 digit text ('840', '036'),
+    #mapped once per distinct value. Text is kept as it is
+    if not (pd.api.types.is_numeric_dtype(values) or values.dtype == object):
+        return values
+    codes = {x: '{:03d}'.format(int(x)) for x in values.dropna().unique()
+             if isinstance(x, numbers.Real) and not isinstance(x, bool) and float(x).is_integer()}
+    if not codes:
+        return values
+    return values.astype(object).where(~values.isin(list(codes)), values.map(codes))
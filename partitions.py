@@ -0,0 +1,161 @@
+#Month partitions of the stored transactions.
+#Rows live in one table per transaction month, data_YYYY_MM, and in data_undated when they have no usable
+#TransactionDate. DataPartitions registers the tables and data is a UNION ALL view over all of them, so
+#purging a month is a DROP TABLE and date ranged queries only read the tables of the months in range.
+#TransactionIds stay unique across partitions, they are handed out from TransactionSequence.
+#Deleted and dropped rows are taken out of the search index (search.py) first.
+import re
+from search import unindexRows, clearIndex
+
+UNDATED = 'undated'
+MONTH = re.compile(r'^\d{4}-\d{2}')
+#Partition month of a stored TransactionDate in sql, same rule as monthsOf
+MONTH_SQL = "CASE WHEN TransactionDate GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]*' THEN substr(TransactionDate, 1, 7) ELSE '{}' END".format(UNDATED)
+
+#Columns of every partition table, in the order of the former data table
+DATA_COLUMNS = """TransactionId integer PRIMARY KEY,
+        MerchantId integer NOT NULL REFERENCES MerchantNames(MerchantId),
+        ClientName text,
+        TransactionDate text,
+        TransactionType text,
+        DataEntryMethod text,
+        CurrencyCode text,
+        DccCurrencyCode text,
+        SaleAmount real,
+        DccAmount real,
+        CardNumber text,
+        AuthMessage text,
+        TerminalId text,
+        CardSchemeId integer REFERENCES CardSchemeNames(CardSchemeId),
+        TransactionMode text,
+        ExpiryDate text,
+        ResponseCode text,
+        UploadTime text,
+        UploadId integer NOT NULL,
+        RowHash integer"""
+
+#Flat transaction columns over {source}, the data view or a union of some partitions
+TRANSACTIONS = """SELECT m.name AS MerchantName, d.ClientName, d.TransactionDate, d.TransactionType, d.DataEntryMethod,
+            d.CurrencyCode, d.DccCurrencyCode, d.SaleAmount, d.DccAmount, d.CardNumber, d.AuthMessage, d.TerminalId,
+            s.name AS CardScheme, d.TransactionMode, d.ExpiryDate, d.ResponseCode, d.UploadTime, d.UploadId, d.TransactionId
+        FROM {source} d
+        JOIN MerchantNames m ON m.MerchantId = d.MerchantId
+        LEFT JOIN CardSchemeNames s ON s.CardSchemeId = d.CardSchemeId"""
+
+
+def _tableName(month):
+    return 'data_' + month.replace('-', '_')
+
+
+def createPartitioning(con):
+    #Registry, id sequence and the undated partition, which is never dropped so the data view is never empty
+    con.execute('CREATE TABLE IF NOT EXISTS DataPartitions(YearMonth text PRIMARY KEY, name text NOT NULL);')
+    con.execute('CREATE TABLE IF NOT EXISTS TransactionSequence(next integer NOT NULL);')
+    if con.execute('SELECT count(*) FROM TransactionSequence;').fetchone()[0] == 0:
+        con.execute('INSERT INTO TransactionSequence (next) VALUES (1);')
+    partitionTable(con, UNDATED)
+
+
+def _rebuildViews(con):
+    tables = [x[1] for x in partitions(con)]
+    con.execute('DROP VIEW IF EXISTS transactions;')
+    con.execute('DROP VIEW IF EXISTS data;')
+    con.execute('CREATE VIEW data AS {};'.format(' UNION ALL '.join('SELECT * FROM {}'.format(x) for x in tables)))
+    #Same columns, in the same order, as before partitioning
+    con.execute('CREATE VIEW transactions AS {};'.format(TRANSACTIONS.format(source='data')))
+
+
+def partitions(con, start=None, end=None):
+    #(YearMonth, table) in month order, start / end ('YYYY-MM') limit them to a range and leave out undated rows
+    rows = con.execute('SELECT YearMonth, name FROM DataPartitions ORDER BY YearMonth;').fetchall()
+    if start is None and end is None:
+        return rows
+    return [x for x in rows if x[0] != UNDATED and (start is None or x[0] >= start) and (end is None or x[0] <= end)]
+
+
+def partitionTable(con, month):
+    #Table of month ('YYYY-MM' or UNDATED), created with its indexes on first use
+    row = con.execute('SELECT name FROM DataPartitions WHERE YearMonth = ?;', (month,)).fetchone()
+    if row is not None:
+        return row[0]
+    name = _tableName(month)
+    con.execute('CREATE TABLE {}({});'.format(name, DATA_COLUMNS))
+    con.execute('CREATE INDEX {0}_TransactionDate ON {0}(TransactionDate);'.format(name))
+    con.execute('CREATE INDEX {0}_UploadId_TransactionDate ON {0}(UploadId, TransactionDate);'.format(name))
+    con.execute('CREATE INDEX {0}_MerchantId_TransactionDate ON {0}(MerchantId, TransactionDate);'.format(name))
+    con.execute('CREATE UNIQUE INDEX {0}_RowHash ON {0}(RowHash);'.format(name))
+    con.execute('INSERT INTO DataPartitions (YearMonth, name) VALUES (?, ?);', (month, name))
+    _rebuildViews(con)
+    return name
+
+
+def monthsOf(dates):
+    #Partition month per stored TransactionDate (ISO text or None)
+    valid = dates.astype(object).where(dates.notnull(), '').astype(str)
+    return valid.str.slice(0, 7).where(valid.str.match(MONTH.pattern), UNDATED)
+
+
+def allocateIds(con, count):
+    #First of count consecutive new TransactionIds, part of the caller's transaction
+    con.execute('UPDATE TransactionSequence SET next = next + ?;', (count,))
+    return con.execute('SELECT next FROM TransactionSequence;').fetchone()[0] - count
+
+
+def transactionsOf(table):
+    #FROM clause with the columns of the transactions view over a single partition table
+    return '({})'.format(TRANSACTIONS.format(source=table))
+
+
+def transactionsIn(con, start=None, end=None):
+    #FROM clause with the columns of the transactions view, reading only the partitions of months start..end
+    if start is None and end is None:
+        return 'transactions'
+    tables = [x[1] for x in partitions(con, start, end)]
+    source = ' UNION ALL '.join('SELECT * FROM {}'.format(x) for x in tables) or 'SELECT * FROM {} WHERE 0'.format(_tableName(UNDATED))
+    return '({})'.format(TRANSACTIONS.format(source='({})'.format(source)))
+
+
+def _reclaim(con):
+    #Hands freed pages back to the file system, a no-op unless the database uses auto_vacuum = INCREMENTAL.
+    #The sqlite3 module steps the pragma once, which frees a single page, so it runs once per free page
+    if con.execute('PRAGMA auto_vacuum;').fetchone()[0] != 2:
+        return
+    for _ in range(con.execute('PRAGMA freelist_count;').fetchone()[0]):
+        con.execute('PRAGMA incremental_vacuum;')
+
+
+def dropPartitions(con, months=None):
+    #Purges whole months (every month when None) by dropping their tables, undated rows are deleted.
+    #Part of the caller's transaction, returns the number of rows removed
+    removed = 0
+    if months is None:
+        clearIndex(con)
+    for month, table in partitions(con):
+        if months is not None and month not in months:
+            continue
+        if months is not None:
+            unindexRows(con, table)
+        if month == UNDATED:
+            removed += con.execute('DELETE FROM {};'.format(table)).rowcount
+            continue
+        removed += con.execute('SELECT count(*) FROM {};'.format(table)).fetchone()[0]
+        con.execute('DROP TABLE {};'.format(table))
+        con.execute('DELETE FROM DataPartitions WHERE YearMonth = ?;', (month,))
+    _rebuildViews(con)
+    _reclaim(con)
+    return removed
+
+
+def deleteRows(con, where, args=()):
+    #DELETE ... WHERE where on every partition, tables left empty are dropped. Returns the number of deleted rows
+    deleted = 0
+    empty = []
+    for month, table in partitions(con):
+        unindexRows(con, table, where, args)
+        count = con.execute('DELETE FROM {} WHERE {};'.format(table, where), args).rowcount
+        deleted += count
+        if count > 0 and month != UNDATED and con.execute('SELECT 1 FROM {} LIMIT 1;'.format(table)).fetchone() is None:
+            empty.append(month)
+    if empty:
+        dropPartitions(con, empty)
+    return deleted
@@ -0,0 +1,288 @@
+#Streaming readers for uploaded transaction files.
+#readChunks yields DataFrames of at most chunksize rows, so an upload never has to be held in memory whole.
+#csv goes through pandas' chunked reader, xlsx and ods are walked row by row from the sheet xml inside the zip.
+#Only the requested columns are converted, the others are skipped cell by cell, and frames are built
+#column by column so pandas infers one dtype per column (float64 amounts, datetime64 xlsx dates).
+#lxml is used when installed, it hands only the row elements to python.
+import zipfile
+import datetime
+import re
+import xml.etree.ElementTree as ET
+import pandas as pd
+try:
+    from lxml import etree as lxmlTree
+except ImportError:
+    lxmlTree = None
+
+CHUNKSIZE = 50000
+#Codes that look like numbers, read from csv as text so '036' or ResponseCode '00' keep their leading zeros,
+#in data.db and in the reject files
+TEXT_COLUMNS = ['CurrencyCode', 'DccCurrencyCode', 'CardNumber', 'AuthMessage', 'TerminalId', 'ExpiryDate', 'ResponseCode']
+
+XLSX_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+XLSX_REL_NS = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+XLSX_PKG_REL_NS = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+ODS_TABLE_NS = '{urn:oasis:names:tc:opendocument:xmlns:table:1.0}'
+ODS_OFFICE_NS = '{urn:oasis:names:tc:opendocument:xmlns:office:1.0}'
+ODS_TEXT_NS = '{urn:oasis:names:tc:opendocument:xmlns:text:1.0}'
+
+#Built in xlsx number formats which are dates or times
+XLSX_DATE_FORMATS = set(range(14, 23)) | set(range(27, 37)) | set(range(45, 48)) | set(range(50, 59))
+XLSX_EPOCH = datetime.datetime(1899, 12, 30)
+
+
+def readChunks(path, extension, chunksize=CHUNKSIZE, columns=None):
+    #columns limits the frames to those columns (the ones present in the file), None reads every column
+    if extension == 'csv':
+        return pd.read_csv(path, chunksize=chunksize, usecols=None if columns is None else (lambda x: x in columns), dtype={x: str for x in TEXT_COLUMNS})
+    elif extension == 'xlsx':
+        return _frames(_xlsxRows(path), chunksize, columns)
+    elif extension == 'ods':
+        return _frames(_odsRows(path), chunksize, columns)
+    raise ValueError('Unsupported file extension {}'.format(extension))
+
+
+def _frame(header, buffer):
+    #One list per column, rows shorter than the header are padded with None
+    data = {}
+    for position, name in enumerate(header):
+        data[name] = [row[position] if position < len(row) else None for row in buffer]
+    return pd.DataFrame(data, columns=header)
+
+
+def _frames(rows, chunksize, columns=None):
+    #rows.send(positions) after the header limits the following rows to the cells at those positions
+    header = None
+    buffer = []
+    yielded = False
+    row = next(rows, None)
+    while row is not None:
+        if header is None:
+            header = [str(x) for x in row]
+            positions = [x for x, name in enumerate(header) if columns is None or name in columns]
+            header = [header[x] for x in positions]
+            try:
+                row = rows.send(positions)
+            except StopIteration:
+                row = None
+            continue
+        buffer.append(row)
+        if len(buffer) == chunksize:
+            yield _frame(header, buffer)
+            yielded = True
+            buffer = []
+        row = next(rows, None)
+
+    #Always hand back at least the header, callers validate columns on the first chunk
+    if header is not None and (buffer or not yielded):
+        yield _frame(header, buffer)
+
+
+def _iterRows(stream, rowTag, stopTag=None):
+    #Yields row elements one at a time, finished rows are dropped so memory stays flat
+    if lxmlTree is not None:
+        for event, elem in lxmlTree.iterparse(stream, events=('end',), tag=(rowTag, stopTag) if stopTag else rowTag, huge_tree=True):
+            if elem.tag == stopTag:
+                return
+            yield elem
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+        return
+
+    #Standard library fallback, tracks parents to detach finished rows
+    parents = []
+    for event, elem in ET.iterparse(stream, events=('start', 'end')):
+        if event == 'start':
+            parents.append(elem)
+            continue
+        parents.pop()
+        if elem.tag == rowTag:
+            yield elem
+            if parents:
+                parents[-1].remove(elem)
+            elem.clear()
+        elif elem.tag == stopTag:
+            return
+
+
+def _children(elem, tags):
+    #Child elements with one of tags, lxml filters them without creating the others
+    if lxmlTree is not None and hasattr(elem, 'iterchildren'):
+        return elem.iterchildren(*tags)
+    return (x for x in elem if x.tag in tags)
+
+
+#XLSX
+def _columnIndex(ref):
+    index = 0
+    for char in ref:
+        if char.isalpha():
+            index = index * 26 + ord(char.upper()) - 64
+        else:
+            break
+    return index - 1
+
+
+def _isDateFormat(code):
+    code = re.sub(r'"[^"]*"|\[[^\]]*\]|\\.', '', code)
+    return re.search(r'[dmyhs]', code, re.IGNORECASE) is not None
+
+
+def _xlsxSheetPath(archive):
+    workbook = ET.fromstring(archive.read('xl/workbook.xml'))
+    sheet = workbook.find(XLSX_NS + 'sheets/' + XLSX_NS + 'sheet')
+    relId = sheet.get(XLSX_REL_NS + 'id')
+    rels = ET.fromstring(archive.read('xl/_rels/workbook.xml.rels'))
+    for rel in rels.iter(XLSX_PKG_REL_NS + 'Relationship'):
+        if rel.get('Id') == relId:
+            target = rel.get('Target')
+            return target.lstrip('/') if target.startswith('/') else 'xl/' + target
+    return 'xl/worksheets/sheet1.xml'
+
+
+def _xlsxSharedStrings(archive):
+    strings = []
+    if 'xl/sharedStrings.xml' not in archive.namelist():
+        return strings
+    with archive.open('xl/sharedStrings.xml') as stream:
+        for item in _iterRows(stream, XLSX_NS + 'si'):
+            strings.append(''.join(t.text or '' for t in item.iter(XLSX_NS + 't')))
+    return strings
+
+
+def _xlsxDateStyles(archive):
+    #Indexes into cellXfs whose number format renders a date
+    if 'xl/styles.xml' not in archive.namelist():
+        return set()
+    styles = ET.fromstring(archive.read('xl/styles.xml'))
+    custom = {int(x.get('numFmtId')): x.get('formatCode', '') for x in styles.iter(XLSX_NS + 'numFmt')}
+    cellXfs = styles.find(XLSX_NS + 'cellXfs')
+    if cellXfs is None:
+        return set()
+    dates = set()
+    for index, xf in enumerate(cellXfs.findall(XLSX_NS + 'xf')):
+        numFmtId = int(xf.get('numFmtId', 0))
+        if numFmtId in XLSX_DATE_FORMATS or (numFmtId in custom and _isDateFormat(custom[numFmtId])):
+            dates.add(index)
+    return dates
+
+
+def _xlsxRows(path):
+    #Yields the header row, then only the cells at the positions sent back for it (see _frames)
+    columnCache = {}
+    with zipfile.ZipFile(path) as archive:
+        strings = _xlsxSharedStrings(archive)
+        dateStyles = _xlsxDateStyles(archive)
+        with archive.open(_xlsxSheetPath(archive)) as stream:
+            keep = None
+            for row in _iterRows(stream, XLSX_NS + 'row'):
+                values = [None] * len(keep) if keep is not None else []
+                found = False
+                position = 0
+                for cell in _children(row, (XLSX_NS + 'c',)):
+                    ref = cell.get('r')
+                    if ref is not None:
+                        letters = ref.rstrip('0123456789')
+                        position = columnCache.get(letters)
+                        if position is None:
+                            position = columnCache[letters] = _columnIndex(letters)
+                    if keep is None:
+                        if position > len(values):
+                            values.extend([None] * (position - len(values)))
+                        values.append(_xlsxValue(cell, strings, dateStyles))
+                        found = found or values[-1] is not None
+                    else:
+                        slot = keep.get(position)
+                        if slot is not None:
+                            values[slot] = _xlsxValue(cell, strings, dateStyles)
+                            found = found or values[slot] is not None
+                    position += 1
+                if not found:
+                    continue
+                if keep is None:
+                    keep = {x: slot for slot, x in enumerate((yield values))}
+                else:
+                    yield values
+
+
+def _xlsxValue(cell, strings, dateStyles):
+    kind = cell.get('t', 'n')
+    if kind == 'inlineStr':
+        return ''.join(t.text or '' for t in cell.iter(XLSX_NS + 't'))
+    #The value is usually the only or last child, find only when a formula or the like follows it
+    value = None
+    if len(cell):
+        last = cell[-1]
+        value = last.text if last.tag == XLSX_NS + 'v' else cell.findtext(XLSX_NS + 'v')
+    if value is None:
+        return None
+    if kind == 's':
+        return strings[int(value)]
+    if kind == 'b':
+        return value == '1'
+    if kind in ('str', 'e', 'd'):
+        return value
+    if int(cell.get('s', 0)) in dateStyles:
+        return XLSX_EPOCH + datetime.timedelta(seconds=round(float(value) * 86400))
+    return int(value) if re.match(r'^-?\d+$', value) else float(value)
+
+
+#ODS
+def _odsValue(cell):
+    kind = cell.get(ODS_OFFICE_NS + 'value-type')
+    if kind is None:
+        return None
+    if kind in ('float', 'percentage', 'currency'):
+        number = float(cell.get(ODS_OFFICE_NS + 'value'))
+        return int(number) if number.is_integer() else number
+    if kind == 'date':
+        return cell.get(ODS_OFFICE_NS + 'date-value')
+    if kind == 'time':
+        return cell.get(ODS_OFFICE_NS + 'time-value')
+    if kind == 'boolean':
+        return cell.get(ODS_OFFICE_NS + 'boolean-value') == 'true'
+    #A single plain paragraph is read straight from .text, only formatted ones need itertext
+    if len(cell) == 1:
+        paragraph = cell[0]
+        if len(paragraph) == 0 and paragraph.tag == ODS_TEXT_NS + 'p':
+            return paragraph.text or ''
+    return '\n'.join(''.join(p.itertext()) for p in cell.iter(ODS_TEXT_NS + 'p'))
+
+
+def _odsRows(path):
+    #Yields the header row, then only the cells at the positions sent back for it (see _frames)
+    cellTags = (ODS_TABLE_NS + 'table-cell', ODS_TABLE_NS + 'covered-table-cell')
+    with zipfile.ZipFile(path) as archive:
+        with archive.open('content.xml') as stream:
+            keep = None
+            #Only the first sheet is read, same as read_ods(path, 0)
+            for row in _iterRows(stream, ODS_TABLE_NS + 'table-row', stopTag=ODS_TABLE_NS + 'table'):
+                if keep is None:
+                    values = []
+                    for cell in row:
+                        if cell.tag in cellTags:
+                            values.extend([_odsValue(cell)] * int(cell.get(ODS_TABLE_NS + 'number-columns-repeated', 1)))
+                    while values and values[-1] is None:
+                        values.pop()
+                    if values:
+                        keep = {x: slot for slot, x in enumerate((yield values))}
+                    continue
+
+                values = [None] * len(keep)
+                found = False
+                position = 0
+                for cell in _children(row, cellTags):
+                    repeat = cell.get(ODS_TABLE_NS + 'number-columns-repeated')
+                    repeat = int(repeat) if repeat is not None else 1
+                    slots = [keep[x] for x in range(position, position + min(repeat, len(keep) + 1)) if x in keep] if repeat > 1 else ([keep[position]] if position in keep else [])
+                    if slots:
+                        value = _odsValue(cell)
+                        for slot in slots:
+                            values[slot] = value
+                        found = found or value is not None
+                    position += repeat
+                if not found:
+                    continue
+                for _ in range(int(row.get(ODS_TABLE_NS + 'number-rows-repeated', 1))):
+                    yield list(values)
@@ -0,0 +1,107 @@
+#Cache of report results keyed by the data version of data.db.
+#DataVersion is bumped in the same transaction as every change to stored transactions (upload,
+#upload delete, export purge), so a cached report is reused until the data it was built from changes.
+#Results are held in an in-process LRU and, optionally, as json files shared by every worker process.
+#The csv download is written once per data version and filter set.
+import os
+import csv
+import json
+import hashlib
+import threading
+import collections
+
+
+def createDataVersion(con):
+    con.execute('CREATE TABLE IF NOT EXISTS DataVersion(version integer NOT NULL);')
+    if con.execute('SELECT count(*) FROM DataVersion;').fetchone()[0] == 0:
+        con.execute('INSERT INTO DataVersion (version) VALUES (0);')
+
+
+def bumpDataVersion(con):
+    #Part of the caller's transaction, committed together with the data change
+    con.execute('UPDATE DataVersion SET version = version + 1;')
+
+
+def dataVersion(con):
+    row = con.execute('SELECT version FROM DataVersion;').fetchone()
+    return row[0] if row else None
+
+
+def reportKey(start, end, merchants):
+    #Stable file name friendly key of one set of report filters
+    raw = json.dumps([start or '', end or '', sorted(merchants or [])])
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()[:16]
+
+
+class ReportCache():
+    def __init__(self, folder, size=64, disk=False):
+        self.folder = folder
+        self.size = size
+        self.disk = disk
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def _path(self, version, key, extension):
+        return os.path.join(self.folder, 'report_{}_{}.{}'.format(version, key, extension))
+
+    def get(self, version, key):
+        #(headers, rows) or None
+        with self.lock:
+            if (version, key) in self.entries:
+                self.entries.move_to_end((version, key))
+                return self.entries[(version, key)]
+        if self.disk and os.path.exists(self._path(version, key, 'json')):
+            with open(self._path(version, key, 'json')) as f:
+                value = json.load(f)
+            value = (value['headers'], [tuple(x) for x in value['rows']])
+            self._remember(version, key, value)
+            return value
+        return None
+
+    def _remember(self, version, key, value):
+        with self.lock:
+            #Entries of older versions can never be hit again
+            for old in [x for x in self.entries if x[0] != version]:
+                del self.entries[old]
+            self.entries[(version, key)] = value
+            self.entries.move_to_end((version, key))
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def put(self, version, key, headers, rows):
+        self._remember(version, key, (headers, rows))
+        if self.disk:
+            self._prune(version)
+            self._write(self._path(version, key, 'json'), lambda f: json.dump({'headers': headers, 'rows': rows}, f))
+
+    def csvPath(self, version, key, headers, rows):
+        #Path of the report csv, written on first request for this version and filters
+        path = self._path(version, key, 'csv')
+        if not os.path.exists(path):
+            self._prune(version)
+            def writeCsv(f):
+                writer = csv.writer(f)
+                writer.writerow(headers)
+                writer.writerows(rows)
+            self._write(path, writeCsv)
+        return path
+
+    def _write(self, path, write):
+        #Written under a temporary name first, a concurrent reader never sees half a file
+        os.makedirs(self.folder, exist_ok=True)
+        temporary = '{}.{}.tmp'.format(path, threading.get_ident())
+        with open(temporary, 'w', newline='') as f:
+            write(f)
+        os.replace(temporary, path)
+
+    def _prune(self, version):
+        #Files of older data versions are stale, newer ones may come from a worker that is ahead of this one
+        if not os.path.isdir(self.folder):
+            return
+        for name in os.listdir(self.folder):
+            parts = name.split('_')
+            if len(parts) == 3 and parts[1].isdigit() and int(parts[1]) < version and not name.endswith('.tmp'):
+                try:
+                    os.remove(os.path.join(self.folder, name))
+                except OSError:
+                    pass
@@ -0,0 +1,124 @@
+#Report engine, the per card scheme pivot is done by sqlite with one GROUP BY query
+#and only the aggregated rows come back to python.
+#Month filters ('YYYY-MM') are answered from the summary rollup, day filters ('YYYY-MM-DD') from the month
+#partitions of transactions within the range.
+#Months already exported to the parquet archive are rolled up by archive.py and merged in through a temp table.
+#A merchant-month that is in data.db again (an exported file uploaded a second time) is counted from data.db only.
+import re
+import datetime
+from archive import archiveRollup
+from metrics import phase
+from partitions import transactionsIn, UNDATED
+
+MONTH = re.compile(r'^\d{4}-\d{2}$')
+DAY = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+
+REPORT_COLUMNS = {'MerchantName': 'Merchant Name', 'TransactionDate': 'Total Count', 'SaleAmount': 'Sale Amount'}
+
+
+def parseFilter(value):
+    #Returns 'month', 'day' or None for an empty value, raises ValueError otherwise
+    if value is None or value == '':
+        return None
+    if MONTH.match(value):
+        datetime.datetime.strptime(value, '%Y-%m')
+        return 'month'
+    if DAY.match(value):
+        datetime.datetime.strptime(value, '%Y-%m-%d')
+        return 'day'
+    raise ValueError('Bad date filter "{}", expected YYYY-MM or YYYY-MM-DD'.format(value))
+
+
+def _source(start, end):
+    kinds = set(x for x in (parseFilter(start), parseFilter(end)) if x is not None)
+    return 'transactions' if 'day' in kinds else 'summary'
+
+
+def _from(con, source, start, end):
+    #Table to select from, transactions only over the partitions of the months in range
+    if source == 'summary':
+        return source
+    return transactionsIn(con, start[:7] if start else None, end[:7] if end else None)
+
+
+def _where(source, start, end, merchants):
+    where = []
+    args = []
+    if source == 'summary':
+        if start or end:
+            #Undated rows fall outside any range, as they do for the TransactionDate filters below
+            where.append('YearMonth != ?')
+            args.append(UNDATED)
+        if start:
+            where.append('YearMonth >= ?')
+            args.append(start[:7])
+        if end:
+            where.append('YearMonth <= ?')
+            args.append(end[:7])
+    else:
+        if start:
+            where.append('TransactionDate >= ?')
+            args.append(start if DAY.match(start) else start + '-01')
+        if end:
+            where.append("TransactionDate < date(?, '+1 day')" if DAY.match(end) else "TransactionDate < date(?, '+1 month')")
+            args.append(end if DAY.match(end) else end + '-01')
+    if merchants:
+        where.append('MerchantName IN ({})'.format(', '.join(['?'] * len(merchants))))
+        args.extend(merchants)
+    return (' WHERE ' + ' AND '.join(where) if where else ''), args
+
+
+def cardSchemes(con, start=None, end=None, merchants=None):
+    source = _source(start, end)
+    where, args = _where(source, start, end, merchants)
+    schemes = con.execute('SELECT DISTINCT CardScheme FROM {}{} ORDER BY 1;'.format(_from(con, source, start, end), where), args).fetchall()
+    #Rows without a CardScheme are NULL in transactions and '' in summary, they only count in the totals
+    return [x[0] for x in schemes if x[0]]
+
+
+def _loadArchived(con, rollup):
+    #Per connection temp table, replaced on every report. Merchant-months the summary also has are dropped,
+    #the live rows stand for them. Returns the card schemes of the archived rows left
+    con.execute('CREATE TEMP TABLE IF NOT EXISTS archived(YearMonth text, MerchantName text, CardScheme text, count integer, amount real);')
+    con.execute('DELETE FROM temp.archived;')
+    con.executemany('INSERT INTO temp.archived VALUES (?, ?, ?, ?, ?);', rollup)
+    con.execute('DELETE FROM temp.archived WHERE EXISTS (SELECT 1 FROM summary WHERE summary.YearMonth = archived.YearMonth AND summary.MerchantName = archived.MerchantName);')
+    con.commit()
+    return [x[0] for x in con.execute('SELECT DISTINCT CardScheme FROM temp.archived;').fetchall() if x[0]]
+
+
+def reportRows(con, start=None, end=None, merchants=None, archive=None):
+    #Returns (column headers, rows), one row per (Year-Month, MerchantName) sorted by both.
+    #archive is the parquet archive folder, its months are included when given
+    source = _source(start, end)
+    schemes = cardSchemes(con, start, end, merchants)
+    where, args = _where(source, start, end, merchants)
+    with phase('report_archive') as p:
+        archived = archiveRollup(archive, start, end, merchants) if archive else []
+        p.rows = len(archived)
+
+    if archived:
+        #Both sides reduced to summary rows, the filters are applied inside the union
+        schemes = sorted(set(schemes) | set(_loadArchived(con, archived)))
+        if source == 'summary':
+            rows = 'SELECT YearMonth, MerchantName, CardScheme, count, amount FROM summary{}'.format(where)
+        else:
+            rows = "SELECT strftime('%Y-%m', TransactionDate) AS YearMonth, MerchantName, CardScheme, 1 AS count, SaleAmount AS amount FROM {}{}".format(_from(con, source, start, end), where)
+        source, where = '({} UNION ALL SELECT * FROM temp.archived)'.format(rows), ''
+        month, total, amount, hit = 'YearMonth', 'sum(count)', 'total(amount)', 'count'
+    elif source == 'summary':
+        month, total, amount, hit = 'YearMonth', 'sum(count)', 'sum(amount)', 'count'
+    else:
+        month, total, amount, hit = "strftime('%Y-%m', TransactionDate)", 'count(*)', 'total(SaleAmount)', '1'
+        source = _from(con, source, start, end)
+
+    pivot = ['sum(CASE WHEN CardScheme = ? THEN {} ELSE 0 END)'.format(hit) for _ in schemes]
+    query = 'SELECT {} AS YearMonth, MerchantName, {}, round({}, 2){} FROM {}{} GROUP BY 1, 2 ORDER BY 1, 2;'.format(
+        month, total, amount, ''.join(', ' + x for x in pivot), source, where)
+    #Grouping and the card scheme pivot both happen in this one query
+    with phase('report_query') as p:
+        rows = con.execute(query, schemes + args).fetchall()
+        p.rows = len(rows)
+
+    headers = ['Year-Month'] + list(REPORT_COLUMNS.values()) + schemes
+    return headers, rows
@@ -0,0 +1,220 @@
+#Versioned schema for data.db, the applied version is kept in PRAGMA user_version.
+#Run directly to migrate an existing data.db in one go:
+#   python3 schema.py [path/to/data.db]
+import sys
+import sqlite3
+import logging
+from summary import UPSERT_FROM_DATA
+from reportcache import createDataVersion
+from partitions import createPartitioning, partitionTable, MONTH_SQL, UNDATED
+from search import createSearchIndex, rebuildIndex
+
+#Lookup tables backing the MerchantName / CardScheme columns of data
+LOOKUPS = {'MerchantName': ('MerchantNames', 'MerchantId'),
+           'CardScheme': ('CardSchemeNames', 'CardSchemeId')}
+
+
+def storedColumns(columns):
+    #Column names of data for a list of transaction columns
+    return [LOOKUPS[x][1] if x in LOOKUPS else x for x in columns]
+
+
+def lookupIds(con, column, names):
+    #Ids for names of a lookup column, adding the ones not seen before
+    table, idColumn = LOOKUPS[column]
+    con.executemany('INSERT OR IGNORE INTO {} (name) VALUES (?);'.format(table), [(x,) for x in names])
+    return {name: rowId for name, rowId in con.execute('SELECT name, {} FROM {};'.format(idColumn, table))}
+
+
+#Columns identifying one transaction, a re-uploaded row hashes to the same RowHash and is skipped
+NATURAL_KEY = ['TerminalId', 'CardNumber', 'TransactionDate', 'SaleAmount', 'AuthMessage']
+
+
+def rowHashes(df):
+    #64 bit hash of the natural key per row, from values as they are stored (ISO dates, float amounts)
+    import pandas as pd
+    keys = pd.DataFrame({x: df[x] for x in NATURAL_KEY})
+    keys['SaleAmount'] = pd.to_numeric(keys['SaleAmount']).astype(float)
+    keys = keys.astype(object).where(keys.notnull(), '').astype(str)
+    return pd.util.hash_pandas_object(keys, index=False).values.view('int64')
+
+
+def _tableColumns(con, table):
+    return [x[1] for x in con.execute('PRAGMA table_info({});'.format(table))]
+
+
+def _v1(con):
+    #Typed data table with integer primary key, lookup foreign keys, ISO dates and indexes
+    con.execute('CREATE TABLE IF NOT EXISTS UploadHistory(uploadtime timestamp, filename text, success boolean, len numeric, UploadId numeric);')
+    con.execute('CREATE TABLE IF NOT EXISTS exportHistory(exportDate timestamp, success boolean, len numeric, filename text, exportId numeric);')
+    con.execute('CREATE INDEX IF NOT EXISTS UploadHistory_UploadId ON UploadHistory(UploadId);')
+
+    con.execute('CREATE TABLE IF NOT EXISTS MerchantNames(MerchantId integer PRIMARY KEY, name text NOT NULL UNIQUE);')
+    con.execute('CREATE TABLE IF NOT EXISTS CardSchemeNames(CardSchemeId integer PRIMARY KEY, name text NOT NULL UNIQUE);')
+
+    legacy = 'data' in [x[0] for x in con.execute("SELECT name FROM sqlite_master WHERE type = 'table';")]
+    if legacy and 'TransactionId' not in _tableColumns(con, 'data'):
+        con.execute('ALTER TABLE data RENAME TO data_v0;')
+    else:
+        legacy = False
+
+    con.execute("""CREATE TABLE IF NOT EXISTS data(
+        TransactionId integer PRIMARY KEY,
+        MerchantId integer NOT NULL REFERENCES MerchantNames(MerchantId),
+        ClientName text,
+        TransactionDate text,
+        TransactionType text,
+        DataEntryMethod text,
+        CurrencyCode text,
+        DccCurrencyCode text,
+        SaleAmount real,
+        DccAmount real,
+        CardNumber text,
+        AuthMessage text,
+        TerminalId text,
+        CardSchemeId integer REFERENCES CardSchemeNames(CardSchemeId),
+        TransactionMode text,
+        ExpiryDate text,
+        ResponseCode text,
+        UploadTime text,
+        UploadId integer NOT NULL);""")
+    con.execute('CREATE INDEX IF NOT EXISTS data_UploadId ON data(UploadId);')
+    con.execute('CREATE INDEX IF NOT EXISTS data_MerchantId_TransactionDate ON data(MerchantId, TransactionDate);')
+
+    #Same columns, in the same order, as the flat table this replaces
+    con.execute("""CREATE VIEW IF NOT EXISTS transactions AS
+        SELECT m.name AS MerchantName, d.ClientName, d.TransactionDate, d.TransactionType, d.DataEntryMethod,
+            d.CurrencyCode, d.DccCurrencyCode, d.SaleAmount, d.DccAmount, d.CardNumber, d.AuthMessage, d.TerminalId,
+            s.name AS CardScheme, d.TransactionMode, d.ExpiryDate, d.ResponseCode, d.UploadTime, d.UploadId, d.TransactionId
+        FROM data d
+        JOIN MerchantNames m ON m.MerchantId = d.MerchantId
+        LEFT JOIN CardSchemeNames s ON s.CardSchemeId = d.CardSchemeId;""")
+
+    if legacy:
+        con.execute("INSERT OR IGNORE INTO MerchantNames (name) SELECT DISTINCT coalesce(MerchantName, '') FROM data_v0;")
+        con.execute('INSERT OR IGNORE INTO CardSchemeNames (name) SELECT DISTINCT CardScheme FROM data_v0 WHERE CardScheme IS NOT NULL;')
+        con.execute("""INSERT INTO data (MerchantId, ClientName, TransactionDate, TransactionType, DataEntryMethod, CurrencyCode,
+                DccCurrencyCode, SaleAmount, DccAmount, CardNumber, AuthMessage, TerminalId, CardSchemeId, TransactionMode,
+                ExpiryDate, ResponseCode, UploadTime, UploadId)
+            SELECT m.MerchantId, o.ClientName, coalesce(strftime('%Y-%m-%d %H:%M:%S', o.TransactionDate), o.TransactionDate),
+                o.TransactionType, o.DataEntryMethod, o.CurrencyCode, o.DccCurrencyCode, o.SaleAmount, o.DccAmount,
+                o.CardNumber, o.AuthMessage, o.TerminalId, s.CardSchemeId, o.TransactionMode, o.ExpiryDate, o.ResponseCode,
+                o.UploadTime, cast(o.UploadId AS integer)
+            FROM data_v0 o
+            JOIN MerchantNames m ON m.name = coalesce(o.MerchantName, '')
+            LEFT JOIN CardSchemeNames s ON s.name = o.CardScheme
+            ORDER BY o.rowid;""")
+        con.execute('DROP TABLE data_v0;')
+        logging.info("Migrated legacy data table, {} rows".format(con.execute('SELECT count(*) FROM data;').fetchone()[0]))
+
+    #Monthly rollup behind the report, backfilled when first created
+    summaryExists = con.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'summary';").fetchone()
+    con.execute('CREATE TABLE IF NOT EXISTS summary(YearMonth text, MerchantName text, CardScheme text, count integer, amount real, PRIMARY KEY (YearMonth, MerchantName, CardScheme));')
+    if summaryExists is None:
+        con.execute(UPSERT_FROM_DATA.format(where='1'), (1, 1))
+
+
+def _v2(con):
+    #Indexes for keyset browsing in (TransactionDate, TransactionId) order, rowid is implicitly the last index column
+    con.execute('CREATE INDEX IF NOT EXISTS data_TransactionDate ON data(TransactionDate);')
+    con.execute('DROP INDEX IF EXISTS data_UploadId;')
+    con.execute('CREATE INDEX IF NOT EXISTS data_UploadId_TransactionDate ON data(UploadId, TransactionDate);')
+
+
+def _v3(con):
+    #Unique RowHash over the natural key for duplicate detection, and per upload skipped counts
+    import pandas as pd
+    con.execute('ALTER TABLE data ADD COLUMN RowHash integer;')
+    con.execute('ALTER TABLE UploadHistory ADD COLUMN skipped numeric DEFAULT 0;')
+
+    cursor = con.execute('SELECT TransactionId, {} FROM data;'.format(", ".join(NATURAL_KEY)))
+    while True:
+        rows = cursor.fetchmany(50000)
+        if not rows:
+            break
+        df = pd.DataFrame(rows, columns=['TransactionId'] + NATURAL_KEY)
+        con.executemany('UPDATE data SET RowHash = ? WHERE TransactionId = ?;', zip(rowHashes(df).tolist(), df['TransactionId'].tolist()))
+
+    #Duplicates stored before this version are kept, only the first copy takes part in the index
+    duplicates = con.execute('UPDATE data SET RowHash = NULL WHERE TransactionId NOT IN (SELECT min(TransactionId) FROM data GROUP BY RowHash);').rowcount
+    if duplicates > 0:
+        logging.info('{} stored duplicate transactions left out of the RowHash index'.format(duplicates))
+    con.execute('CREATE UNIQUE INDEX IF NOT EXISTS data_RowHash ON data(RowHash);')
+
+
+def _v4(con):
+    #Version stamp of the stored transactions, report results are cached per version
+    createDataVersion(con)
+
+
+def _v5(con):
+    #data split into one table per transaction month behind a data view, see partitions.py.
+    #The transactions view refers to data by name, it is dropped before the rename and recreated by the partitions
+    con.execute('DROP VIEW IF EXISTS transactions;')
+    con.execute('ALTER TABLE data RENAME TO data_v4;')
+    createPartitioning(con)
+
+    months = [x[0] for x in con.execute('SELECT DISTINCT {} FROM data_v4;'.format(MONTH_SQL))]
+    for month in months:
+        table = partitionTable(con, month)
+        if month == UNDATED:
+            con.execute("INSERT INTO {} SELECT * FROM data_v4 WHERE {} = '{}';".format(table, MONTH_SQL, UNDATED))
+        else:
+            #Range on the TransactionDate index, holds exactly the dates starting with month
+            con.execute('INSERT INTO {} SELECT * FROM data_v4 WHERE TransactionDate >= ? AND TransactionDate < ?;'.format(table), (month, month + '~'))
+    con.execute('UPDATE TransactionSequence SET next = (SELECT coalesce(max(TransactionId), 0) + 1 FROM data_v4);')
+    con.execute('DROP TABLE data_v4;')
+    logging.info('Transactions split into {} month partitions'.format(len(months)))
+
+
+def _v6(con):
+    #Full text index and card number suffix index for /search, see search.py
+    createSearchIndex(con)
+    rebuildIndex(con)
+
+
+def _v7(con):
+    #Rows rejected by validation per upload, their count per rule (json) and the reject csv
+    con.execute('ALTER TABLE UploadHistory ADD COLUMN rejected numeric DEFAULT 0;')
+    con.execute('ALTER TABLE UploadHistory ADD COLUMN rejectCounts text;')
+    con.execute('ALTER TABLE UploadHistory ADD COLUMN rejectFile text;')
+
+
+def _v8(con):
+    #Summary rows of undated transactions or without a CardScheme were keyed by NULLs, which never met
+    #their removals, they are counted again under the keys summary.py uses now. Rows already under those
+    #keys go too, _v1 backfills a legacy database with the current UPSERT_FROM_DATA
+    con.execute("DELETE FROM summary WHERE YearMonth IS NULL OR YearMonth = ? OR CardScheme IS NULL OR CardScheme = '';", (UNDATED,))
+    con.execute(UPSERT_FROM_DATA.format(where="strftime('%Y-%m', TransactionDate) IS NULL OR CardScheme IS NULL"), (1, 1))
+
+
+MIGRATIONS = [_v1, _v2, _v3, _v4, _v5, _v6, _v7, _v8]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def migrate(con):
+    #Applies every migration newer than the database, each one in its own transaction
+    version = con.execute('PRAGMA user_version;').fetchone()[0]
+    if version == 0 and con.execute('SELECT count(*) FROM sqlite_master;').fetchone()[0] == 0:
+        #Only possible before the first table exists, lets dropped partitions shrink the file. Connections from
+        #db.py have set it already (before WAL, which writes the first page), this covers plain ones like __main__
+        con.execute('PRAGMA auto_vacuum = INCREMENTAL;')
+    for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+        try:
+            con.execute('BEGIN IMMEDIATE;')
+            migration(con)
+            con.execute('PRAGMA user_version = {};'.format(number))
+            con.commit()
+        except:
+            con.rollback()
+            logging.info('Schema migration to version {} failed'.format(number))
+            raise
+        logging.info('data.db migrated to schema version {}'.format(number))
+    return con.execute('PRAGMA user_version;').fetchone()[0]
+
+
+if __name__ == '__main__':
+    path = sys.argv[1] if len(sys.argv) > 1 else 'data.db'
+    con = sqlite3.connect(path)
+    print('{} is at schema version {}'.format(path, migrate(con)))
+    con.close()
@@ -0,0 +1,108 @@
+#Search index over stored transactions for finding single rows.
+#TransactionSearch is an FTS5 table over ClientName, AuthMessage and TerminalId. It keeps only the index,
+#the text itself is read from the data view (external content, rowid = TransactionId). CardSuffixes holds
+#every CardNumber reversed, so a suffix of a masked number ('...1234') is an index range on its reversed prefix.
+#Both are kept in sync by the partition code, rows are indexed after they are inserted and unindexed before
+#they are deleted or their partition is dropped.
+import re
+
+SEARCH_COLUMNS = ['ClientName', 'AuthMessage', 'TerminalId']
+SEARCH_LIMIT = 50
+MAX_SEARCH_LIMIT = 500
+#Terms of a search, the same characters the unicode61 tokenizer keeps
+TERM = re.compile(r'[^\W_]+')
+
+
+def _reverse(value):
+    return value[::-1] if isinstance(value, str) else None
+
+
+def _functions(con):
+    #reverse() for the statements below, registering again on the same connection is cheap
+    con.create_function('reverse', 1, _reverse)
+
+
+def createSearchIndex(con):
+    #detail=column leaves out token positions, searches are single terms ANDed so phrases are never needed
+    con.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS TransactionSearch USING fts5({},
+        content='data', content_rowid='TransactionId', detail=column, prefix='3');""".format(", ".join(SEARCH_COLUMNS)))
+    con.execute('CREATE TABLE IF NOT EXISTS CardSuffixes(Reversed text NOT NULL, TransactionId integer NOT NULL, PRIMARY KEY (Reversed, TransactionId)) WITHOUT ROWID;')
+
+
+def indexRows(con, table, where='1', args=()):
+    #Adds the rows of a partition table matching where, part of the caller's transaction
+    _functions(con)
+    con.execute('INSERT INTO TransactionSearch (rowid, {0}) SELECT TransactionId, {0} FROM {1} WHERE {2};'.format(
+        ", ".join(SEARCH_COLUMNS), table, where), args)
+    con.execute('INSERT OR IGNORE INTO CardSuffixes (Reversed, TransactionId) SELECT reverse(CardNumber), TransactionId FROM {} WHERE CardNumber IS NOT NULL AND {};'.format(
+        table, where), args)
+
+
+def unindexRows(con, table, where='1', args=()):
+    #Removes the rows of a partition table matching where, before they are deleted. An external content
+    #index deletes by the values it indexed, they are still in the table at this point
+    _functions(con)
+    con.execute("INSERT INTO TransactionSearch (TransactionSearch, rowid, {0}) SELECT 'delete', TransactionId, {0} FROM {1} WHERE {2};".format(
+        ", ".join(SEARCH_COLUMNS), table, where), args)
+    con.execute('DELETE FROM CardSuffixes WHERE (Reversed, TransactionId) IN (SELECT reverse(CardNumber), TransactionId FROM {} WHERE CardNumber IS NOT NULL AND {});'.format(
+        table, where), args)
+
+
+def clearIndex(con):
+    #Every stored row is going away
+    con.execute("INSERT INTO TransactionSearch (TransactionSearch) VALUES ('delete-all');")
+    con.execute('DELETE FROM CardSuffixes;')
+
+
+def rebuildIndex(con):
+    #Indexes everything in data again, for a new index over existing rows
+    _functions(con)
+    con.execute("INSERT INTO TransactionSearch (TransactionSearch) VALUES ('rebuild');")
+    con.execute('DELETE FROM CardSuffixes;')
+    con.execute('INSERT INTO CardSuffixes (Reversed, TransactionId) SELECT reverse(CardNumber), TransactionId FROM data WHERE CardNumber IS NOT NULL;')
+
+
+def matchQuery(text):
+    #FTS5 query for free text, every term must match as a prefix of a word. None when text has no terms
+    terms = TERM.findall(text)
+    if not terms:
+        return None
+    return ' '.join('"{}"*'.format(x) for x in terms)
+
+
+def _suffixRange(suffix):
+    #Reversed CardNumbers ending with suffix sort in [low, high)
+    low = suffix[::-1]
+    return low, low[:-1] + chr(ord(low[-1]) + 1)
+
+
+def searchIds(con, text='', cardSuffix='', limit=SEARCH_LIMIT):
+    #TransactionIds matching the text and the card number suffix, best text match first, newest first
+    #for a card suffix alone
+    limit = max(1, min(int(limit), MAX_SEARCH_LIMIT))
+    query = matchQuery(text or '')
+    cardSuffix = (cardSuffix or '').strip()
+    if query is None and not cardSuffix:
+        raise ValueError('Nothing to search for, enter a text or a card number suffix')
+    if query is None:
+        return [x[0] for x in con.execute('SELECT TransactionId FROM CardSuffixes WHERE Reversed >= ? AND Reversed < ? ORDER BY TransactionId DESC LIMIT ?;',
+            _suffixRange(cardSuffix) + (limit,))]
+
+    where = 'TransactionSearch MATCH ?'
+    args = [query]
+    if cardSuffix:
+        #+rowid keeps the suffix ids out of the FTS5 plan, which would otherwise run the MATCH once per id
+        where += ' AND +rowid IN (SELECT TransactionId FROM CardSuffixes WHERE Reversed >= ? AND Reversed < ?)'
+        args.extend(_suffixRange(cardSuffix))
+    return [x[0] for x in con.execute('SELECT rowid FROM TransactionSearch WHERE {} ORDER BY rank LIMIT ?;'.format(where), args + [limit])]
+
+
+def searchTransactions(con, columns, text='', cardSuffix='', limit=SEARCH_LIMIT):
+    #Rows of columns followed by TransactionId, in the order of searchIds
+    ids = searchIds(con, text, cardSuffix, limit)
+    if not ids:
+        return []
+    rows = con.execute('SELECT {}, TransactionId FROM transactions WHERE TransactionId IN ({});'.format(
+        ", ".join(columns), ", ".join(['?'] * len(ids))), ids).fetchall()
+    order = {x: position for position, x in enumerate(ids)}
+    return sorted(rows, key=lambda x: order[x[-1]])
@@ -0,0 +1,37 @@
+#Monthly rollup of the data table, created by schema.py and keyed by (YearMonth, MerchantName, CardScheme).
+#Kept up to date on upload and rolled back on deletes, both aggregated in sql over the affected rows,
+#so the report reads merchant-months instead of every stored transaction.
+#No key column is ever NULL, a NULL key never meets ON CONFLICT and a removal would add a second row
+#instead of cancelling the first. Rows without a usable TransactionDate are kept under the YearMonth UNDATED,
+#rows without a CardScheme under ''.
+from partitions import UNDATED
+
+SUMMARY_COLUMNS = ['YearMonth', 'MerchantName', 'CardScheme', 'count', 'amount']
+
+#Aggregates rows of transactions matching {where} and adds them (sign 1) or subtracts them (sign -1)
+#WHERE is always present, sqlite needs it to parse INSERT ... SELECT ... ON CONFLICT
+UPSERT_FROM_DATA = """INSERT INTO summary (YearMonth, MerchantName, CardScheme, count, amount)
+    SELECT coalesce(strftime('%Y-%m', TransactionDate), '""" + UNDATED + """'), MerchantName, coalesce(CardScheme, ''), ? * count(*), ? * total(SaleAmount)
+    FROM transactions WHERE {where} GROUP BY 1, 2, 3
+    ON CONFLICT(YearMonth, MerchantName, CardScheme) DO UPDATE SET count = count + excluded.count, amount = amount + excluded.amount;"""
+
+
+def summaryAdd(con, where='1', args=(), commit=True):
+    #Add rows of transactions matching where, run after those rows are inserted
+    con.execute(UPSERT_FROM_DATA.format(where=where), (1, 1) + tuple(args))
+    if commit:
+        con.commit()
+
+
+def summaryRemove(con, where='1', args=(), commit=True):
+    #Subtract rows of transactions matching where, must run before those rows are deleted
+    con.execute(UPSERT_FROM_DATA.format(where=where), (-1, -1) + tuple(args))
+    con.execute('DELETE FROM summary WHERE count <= 0;')
+    if commit:
+        con.commit()
+
+
+def summaryClear(con, commit=True):
+    con.execute('DELETE FROM summary;')
+    if commit:
+        con.commit()
@@ -0,0 +1,96 @@
+#Row level validation of uploaded chunks.
+#Every rule is a boolean mask over whole columns. Format rules are checked on the distinct values of a
+#column only and spread to the rows with one isin, so they cost next to nothing on large files.
+#Rows failing any rule are left out of the upload and written as they were read, with their reasons,
+#to a reject csv the user can fix and upload again.
+import re
+import pandas as pd
+
+#Rule names, in the order reasons are listed, the per rule counts are kept under these keys
+RULES = ['required', 'date', 'amount', 'currency', 'expiry']
+REQUIRED_COLUMNS = ['TransactionDate', 'SaleAmount', 'CardNumber', 'TerminalId']
+CURRENCY_COLUMNS = ['CurrencyCode', 'DccCurrencyCode']
+#ISO 4217 alphabetic or numeric code
+CURRENCY = re.compile(r'^([A-Za-z]{3}|\d{3})$')
+#MM/YY or MM/YYYY, or the ISO date a spreadsheet date cell is read as
+EXPIRY = re.compile(r'^((0?[1-9]|1[0-2])/(\d{2}|\d{4})|\d{4}-\d{2}(-\d{2}.*)?)$')
+REASON_COLUMN = 'RejectReason'
+
+
+def _blank(values, suspects=None):
+    #Missing or only whitespace. suspects limits the whitespace check to those rows, eg the ones that
+    #did not parse, every other row is known to hold a value
+    missing = values.isnull()
+    if values.dtype.kind in 'biufcmM':
+        return missing
+    if suspects is None:
+        return missing | values.astype(str).str.strip().eq('')
+    check = values[suspects & ~missing]
+    return missing | check.astype(str).str.strip().eq('').reindex(values.index, fill_value=False)
+
+
+def _badFormat(values, pattern):
+    #Present values not matching pattern, evaluated once per distinct value. Blank ones count as absent
+    present = values.dropna()
+    if present.empty:
+        return pd.Series(False, index=values.index)
+    if present.dtype.kind in 'mM':
+        return pd.Series(False, index=values.index)
+    bad = [x for x in present.unique() if str(x).strip() and not pattern.match(str(x).strip())]
+    return values.isin(bad) if bad else pd.Series(False, index=values.index)
+
+
+def validateChunk(raw, normalized):
+    #raw holds the values as read, normalized the parsed TransactionDate / SaleAmount (NaN where parsing failed)
+    #and currency codes.
+    #Returns (mask of good rows, reasons of the bad rows, {rule: rows failing it})
+    #A parsed date or amount is never blank, only the rows that failed are checked
+    unparsed = {x: normalized[x].isnull() for x in ['TransactionDate', 'SaleAmount']}
+    blanks = {x: _blank(raw[x], unparsed.get(x)) for x in REQUIRED_COLUMNS if x in raw.columns}
+    failures = []
+    for col in REQUIRED_COLUMNS:
+        failures.append(('required', blanks[col] if col in blanks else pd.Series(True, index=raw.index), '{} missing'.format(col)))
+    if 'TransactionDate' in blanks:
+        failures.append(('date', unparsed['TransactionDate'] & ~blanks['TransactionDate'], 'TransactionDate not a date'))
+    if 'SaleAmount' in blanks:
+        failures.append(('amount', unparsed['SaleAmount'] & ~blanks['SaleAmount'], 'SaleAmount not a number'))
+    for col in CURRENCY_COLUMNS:
+        if col in raw.columns:
+            #Checked as stored, numeric codes read as numbers are 3 digit text there
+            failures.append(('currency', _badFormat(normalized[col], CURRENCY), '{} not a currency code'.format(col)))
+    if 'ExpiryDate' in raw.columns:
+        failures.append(('expiry', _badFormat(raw['ExpiryDate'], EXPIRY), 'ExpiryDate not MM/YY'))
+
+    bad = pd.Series(False, index=raw.index)
+    counts = {x: 0 for x in RULES}
+    byRule = {}
+    for rule, mask, reason in failures:
+        bad |= mask
+        byRule[rule] = byRule[rule] | mask if rule in byRule else mask
+    for rule, mask in byRule.items():
+        counts[rule] = int(mask.sum())
+
+    #Reasons are only built for the bad rows
+    reasons = pd.Series('', index=bad[bad].index, dtype=object)
+    if not reasons.empty:
+        for rule, mask, reason in failures:
+            hit = mask[bad]
+            if hit.any():
+                reasons[hit] = reasons[hit] + '; ' + reason
+        reasons = reasons.str.slice(2)
+    return ~bad, reasons, counts
+
+
+class RejectWriter():
+    #Appends rejected rows of one upload to path, the file is only created for the first one
+    def __init__(self, path):
+        self.path = path
+        self.rows = 0
+
+    def write(self, raw, reasons):
+        if reasons.empty:
+            return
+        rejects = raw.loc[reasons.index].copy()
+        rejects[REASON_COLUMN] = reasons
+        rejects.to_csv(self.path, mode='a', header=self.rows == 0, index=False)
+        self.rows += rejects.shape[0]